@@ -4,14 +4,185 @@ Creation Date: Nov 2021
 Company:       XtractPro Software
 """
 
-import os, sys
+import os, sys, re, time, math
+import io, json, hashlib
+import queue, threading
+import socket, socketserver
+import functools, contextlib, collections, bisect, heapq
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import configparser
 import snowflake.connector
 from pathlib import Path
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
+# max number of bound values per IN-list, when looking up queries in bulk
+BATCH_SIZE = 1000
+
+LOOKER_CONTEXT = "-- Looker Query Context"
+
+# key of a query in Snowflake: the same for queries differing only in literals, when the hash is available
+QUERY_KEY_SQL = ("coalesce(QUERY_PARAMETERIZED_HASH, md5("
+    f"case when not contains(QUERY_TEXT, '{LOOKER_CONTEXT}') then QUERY_TEXT "
+    f"else left(QUERY_TEXT, position('{LOOKER_CONTEXT}' in QUERY_TEXT)) end))")
+
+# columns of QUERY_HISTORY shown in the report, in both schemas, and in ACCOUNT_USAGE only
+HISTORY_COLUMNS = ["QUERY_ID", "QUERY_TEXT", "QUERY_TYPE", "QUERY_TAG", "QUERY_PARAMETERIZED_HASH",
+    "DATABASE_NAME", "SCHEMA_NAME", "USER_NAME", "ROLE_NAME",
+    "WAREHOUSE_NAME", "WAREHOUSE_SIZE", "WAREHOUSE_TYPE", "CLUSTER_NUMBER",
+    "EXECUTION_STATUS", "ERROR_CODE", "ERROR_MESSAGE", "START_TIME", "END_TIME",
+    "TOTAL_ELAPSED_TIME", "COMPILATION_TIME", "EXECUTION_TIME",
+    "QUEUED_PROVISIONING_TIME", "QUEUED_REPAIR_TIME", "QUEUED_OVERLOAD_TIME", "TRANSACTION_BLOCKED_TIME",
+    "BYTES_SCANNED", "ROWS_PRODUCED", "CREDITS_USED_CLOUD_SERVICES",
+    "INBOUND_DATA_TRANSFER_CLOUD", "INBOUND_DATA_TRANSFER_REGION", "INBOUND_DATA_TRANSFER_BYTES",
+    "OUTBOUND_DATA_TRANSFER_CLOUD", "OUTBOUND_DATA_TRANSFER_REGION", "OUTBOUND_DATA_TRANSFER_BYTES",
+    "EXTERNAL_FUNCTION_TOTAL_INVOCATIONS", "EXTERNAL_FUNCTION_TOTAL_SENT_ROWS", "EXTERNAL_FUNCTION_TOTAL_RECEIVED_ROWS",
+    "EXTERNAL_FUNCTION_TOTAL_SENT_BYTES", "EXTERNAL_FUNCTION_TOTAL_RECEIVED_BYTES"]
+ACCOUNT_USAGE_COLUMNS = ["QUERY_LOAD_PERCENT", "ROWS_INSERTED", "ROWS_UPDATED", "ROWS_DELETED", "ROWS_UNLOADED",
+    "BYTES_WRITTEN", "BYTES_DELETED", "BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE",
+    "PERCENTAGE_SCANNED_FROM_CACHE", "PARTITIONS_SCANNED", "PARTITIONS_TOTAL"]
+
+# lookups start with a narrow START_TIME window, widened LOOKUP_WINDOW_GROWTH times on each miss,
+# up to the retention of the schema: (hours of the first window, days of retention)
+LOOKUP_WINDOWS = { "ACCOUNT_USAGE": (24, 365), "INFORMATION_SCHEMA": (1, 7) }
+LOOKUP_WINDOW_GROWTH = 8
+INFORMATION_SCHEMA_RESULT_LIMIT = 10000
+# the END_TIME range of INFORMATION_SCHEMA ends this long after the START_TIME window (longer queries are missed)
+INFORMATION_SCHEMA_END_SLACK_HOURS = 1
+UTC_TIME_SQL = "to_timestamp_tz(? || ' +00:00', 'YYYY-MM-DD HH24:MI:SS.FF TZH:TZM')"
+
+# queries not found are not run by default, but estimated from their EXPLAIN plan. Otherwise, they run with
+# a timeout (seconds), for only a few seconds (enough for a cached result, or a quick query), or with a cap on their rows
+NOT_FOUND_MODES = ["explain", "cache", "limit", "run"]
+RUN_TIMEOUT_SECONDS = 60
+CACHE_CHECK_SECONDS = 5
+RUN_ROW_LIMIT = 1000
+# error number of the statements cancelled on timeout
+QUERY_CANCELLED_ERRNO = 604
+
+# the profiler's own statements are tagged, and left out of the rankings, mirror and workload
+PROFILER_QUERY_TAG = "query-profiler"
+NOT_PROFILER_SQL = f"coalesce(QUERY_TAG, '') <> '{PROFILER_QUERY_TAG}'"
+
+# tokens of a query text, for the local fingerprint
+QUERY_TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>--[^\n]*|//[^\n]*|/\*.*?\*/)
+    | (?P<literal>'(?:[^'\\]|\\.|'')*'|\$\$.*?\$\$|(?<![\w$])(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    | (?P<ident>"(?:[^"]|"")*")
+    | (?P<space>\s+)
+    | (?P<other>[\w$]+|.)
+    """, re.DOTALL | re.VERBOSE)
+IN_LIST_PATTERN = re.compile(r"\( \?(?: , \?)+ \)")
+
+# top N queries kept in each leaderboard
+RANKING_LIMIT = 100
+
+# on-disk cache of the leaderboards
+CACHE_DIR = os.path.join(str(Path.home()), ".query-profiler", "cache")
+CACHE_TTL_MINUTES = 60
+CACHE_MAX_BYTES = 10 * 1024 * 1024
+# cache files are evicted by one thread at a time
+CACHE_LOCK = threading.Lock()
+
+# thresholds of the hints, that can be overriden in a [thresholds] section of profiles_db.conf
+# (a join producing more than JOIN_EXPLOSION_FACTOR times its input rows is exploding,
+# recent runs over BASELINE_SHIFT_RATIO times the median of a query have shifted,
+# and the watch mode profiles the queries slower than WATCH_ELAPSED_MS)
+THRESHOLDS = {
+    "SPILL_BYTES": 1000000,
+    "SCAN_BYTES": 10000000,
+    "CACHE_HIGH_RATIO": 0.8,
+    "CACHE_LOW_RATIO": 0.5,
+    "PRUNING_RATIO": 0.2,
+    "JOIN_EXPLOSION_FACTOR": 2,
+    "BASELINE_SHIFT_RATIO": 1.5,
+    "WATCH_ELAPSED_MS": 60000 }
+# price of a compute credit, in dollars, that can be overriden in a [costs] section of profiles_db.conf
+COSTS = { "CREDIT_PRICE": 3.0 }
+OPERATOR_FLAGS = { "spilling": "spilling", "poorPruning": "poor pruning", "explodingJoin": "exploding join" }
+# number of most expensive operators shown
+TOP_OPERATORS = 5
+
+# statistics of the whole EXPLAIN plan, and of each TableScan
+PLAN_STATS = ["partitionsTotal", "partitionsAssigned", "bytesAssigned"]
+PLAN_STAT_PATTERN = re.compile(r"^\s*(\w+)=(\d+)\s*$", re.MULTILINE)
+PLAN_LINE_PATTERN = re.compile(r"^(\d+):(\d+)\s+->(\w+)(.*)$")
+
+# workload report: queries per fetched batch, fingerprints kept, top fingerprints shown,
+# and relative accuracy of the percentiles
+WORKLOAD_DAYS = 30
+WORKLOAD_BATCH_ROWS = 100000
+WORKLOAD_MAX_FINGERPRINTS = 100000
+WORKLOAD_TOP = 20
+SKETCH_GAMMA = 1.02
+# error number of fetch_pandas_batches, when the connector has been installed without pandas
+NO_PANDAS_ERRNO = 255002
+
+# contention: queries on the same warehouse, fetched once per batch, in windows merged when closer than
+# CONTENTION_MERGE_MINUTES, and started at most CONTENTION_LOOKBACK_HOURS before (longer queries are missed)
+CONTENTION_MERGE_MINUTES = 60
+CONTENTION_LOOKBACK_HOURS = 24
+CONTENTION_TOP = 5
+
+# watch mode: seconds between polls, END_TIME re-read before the high-watermark, and query IDs remembered
+# (to skip those re-read)
+WATCH_INTERVAL_SECONDS = 30
+WATCH_OVERLAP_SECONDS = 15
+WATCH_SEEN_IDS = 100000
+
+# local Unix socket of the profiler server
+SERVER_SOCKET = os.path.join(str(Path.home()), ".query-profiler", "server.sock")
+
+# structured output: numeric metrics as Parquet columns, and rows per Parquet row group
+OUTPUT_FORMATS = ["text", "json", "ndjson", "parquet"]
+PARQUET_METRICS = ["TOTAL_ELAPSED_TIME", "COMPILATION_TIME", "EXECUTION_TIME",
+    "QUEUED_PROVISIONING_TIME", "QUEUED_REPAIR_TIME", "QUEUED_OVERLOAD_TIME", "TRANSACTION_BLOCKED_TIME",
+    "BYTES_SCANNED", "PERCENTAGE_SCANNED_FROM_CACHE", "PARTITIONS_SCANNED", "PARTITIONS_TOTAL",
+    "BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE", "ROWS_PRODUCED", "CREDITS_USED_CLOUD_SERVICES"]
+PARQUET_BATCH_ROWS = 100
+
+# labels of the profiler's own statements, by their SQL, in --trace, and default trace file
+TRACE_LABELS = [
+    (re.compile(r"^with history as", re.IGNORECASE), "ranking leaderboards"),
+    (re.compile(r"^select coalesce", re.IGNORECASE), "workload"),
+    (re.compile(r"information_schema\.query_history.*qualify", re.IGNORECASE | re.DOTALL), "lookup in INFORMATION_SCHEMA"),
+    (re.compile(r"account_usage\.query_history.*qualify", re.IGNORECASE | re.DOTALL), "lookup in ACCOUNT_USAGE"),
+    (re.compile(r"^select QUERY_ID, QUERY_TEXT, START_TIME", re.IGNORECASE), "mirror sync"),
+    (re.compile(r"^select QUERY_ID, USER_NAME, START_TIME", re.IGNORECASE), "co-running queries"),
+    (re.compile(r"end_time_range_end", re.IGNORECASE), "watch poll"),
+    (re.compile(r"warehouse_load_history", re.IGNORECASE), "warehouse load"),
+    (re.compile(r"warehouse_metering_history", re.IGNORECASE), "metering sync"),
+    (re.compile(r"^explain", re.IGNORECASE), "EXPLAIN"),
+    (re.compile(r"get_query_operator_stats", re.IGNORECASE), "operator stats"),
+    (re.compile(r"last_query_id", re.IGNORECASE), "last query ID") ]
+TRACE_FILE = "query-profiler-trace.json"
+
+# max number of statements in flight at the same time, on their own cursors
+CONCURRENCY = 4
+
+# local mirror of ACCOUNT_USAGE.QUERY_HISTORY
+MIRROR_FILE = "query_history.db"
+MIRROR_RETENTION_DAYS = 31
+MIRROR_STALE_HOURS = 24
+# queries are added to ACCOUNT_USAGE only once completed, so re-read a bit before the last START_TIME
+MIRROR_SYNC_OVERLAP_HOURS = 2
+MIRROR_EPOCH = datetime(1970, 1, 1)
+# metered hours of the warehouses are revised for a few hours, so re-read them from before the last one
+METERING_SYNC_OVERLAP_HOURS = 6
+
+# baselines of each fingerprint in the mirror: metrics, min runs to compare with, and weight of the last run
+BASELINE_METRICS = { "TOTAL_ELAPSED_TIME": "elapsed time", "BYTES_SCANNED": "data scanned",
+    "BYTES_SPILLED": "data spilled", "QUEUED_TIME": "time queued" }
+BASELINE_MIN_RUNS = 10
+BASELINE_QUANTILE = 0.95
+BASELINE_EWMA_ALPHA = 0.1
+
+QUERY_ID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE)
+
 def dumpDictionary(props):
     for key in props:
         print(key + "=" + str(props[key]))
@@ -27,99 +198,855 @@ def sizeof_fmt(num, suffix = ""):
     s = f"{num:.1f}Yi{suffix}"
     return s if num == orig_num else s + suffix_bytes
 
-# check number of execs in the past month
-def checkExecNumber(queryText, cur):
-    cur.execute(
-        "SELECT sum(TOTAL_ELAPSED_TIME) / 1000 as TOTAL_TIME_SECONDS, "
-        "count(*) as NUMBER_OF_CALLS "
-        "from SNOWFLAKE.ACCOUNT_USAGE.QUERY_HISTORY "
-        "where QUERY_TEXT = ? "
-        "and TO_DATE(START_TIME) > DATEADD(month, -1, TO_DATE(CURRENT_TIMESTAMP()))",
-        (queryText,))
-    row = cur.fetchone()
-    if row == None:
-        print("It has not been executed at all in the last month.")
-        return 0
-    else:
-        print(f"It has been executed {row[1]} times in the last month, for a total of {row[0]} seconds.")
-        return int(row[1])
+def queryHash(queryText):
+    # same as MD5(QUERY_TEXT) in Snowflake
+    return hashlib.md5(queryText.encode("utf-8")).hexdigest()
 
-# among top N most frequently used queries?
-def isFrequentQuery(queryText, n, cur):
+def cutLookerContext(queryText):
+    # same as the QUERY_KEY_SQL cut in Snowflake
+    pos = queryText.find(LOOKER_CONTEXT)
+    return queryText if pos < 0 else queryText[:pos + 1]
+
+def queryKey(props):
+    """
+    Key of a query in Snowflake: its QUERY_PARAMETERIZED_HASH, or the MD5 of its text, as in QUERY_KEY_SQL
+    """
+    parameterizedHash = props.get('QUERY_PARAMETERIZED_HASH')
+    return parameterizedHash if parameterizedHash else queryHash(cutLookerContext(props['QUERY_TEXT']))
+
+def normalizeQuery(queryText):
+    """
+    Normalize a query text: no comments or Looker context, literals replaced by ?,
+    IN-lists collapsed, lowercase outside quoted identifiers, single spaces between tokens
+    """
+    pos = queryText.find(LOOKER_CONTEXT)
+    if pos >= 0:
+        queryText = queryText[:pos]
+    tokens = []
+    for match in QUERY_TOKEN_PATTERN.finditer(queryText):
+        kind = match.lastgroup
+        if kind == "literal":
+            tokens.append("?")
+        elif kind == "ident":
+            tokens.append(match.group())
+        elif kind == "other":
+            tokens.append(match.group().lower())
+    while len(tokens) > 0 and tokens[-1] == ";":
+        tokens.pop()
+    return IN_LIST_PATTERN.sub("( ? )", " ".join(tokens))
+
+def queryFingerprint(queryText):
+    """
+    Stable fingerprint of a query text, the same for queries differing only in literals, whitespace or comments
+    """
+    return hashlib.md5(normalizeQuery(queryText).encode("utf-8")).hexdigest()
+
+# top N queries per leaderboard, and execs of all queries, in a single ACCOUNT_USAGE pass
+def getLeaderboards(cur, n = RANKING_LIMIT):
+    """
+    Returns the ranks of the top N most frequent, longest and heaviest queries in the past month,
+    by query key, with the number of executions and total time of every query key, to be cached together
+    """
     cur.execute(
-        "with topFrequent as ( "
-        "select case when not contains(QUERY_TEXT, '-- Looker Query Context') then QUERY_TEXT "
-        "else left(QUERY_TEXT, position('-- Looker Query Context' in QUERY_TEXT)) end as query_text_cut "
+        "with history as ( "
+        f"select {QUERY_KEY_SQL} as QUERY_KEY, TOTAL_ELAPSED_TIME, BYTES_SCANNED, ERROR_CODE, PARTITIONS_SCANNED "
         "from SNOWFLAKE.ACCOUNT_USAGE.QUERY_HISTORY "
         "where TO_DATE(START_TIME) > DATEADD(month, -1, TO_DATE(CURRENT_TIMESTAMP())) "
-        "and TOTAL_ELAPSED_TIME > 0 "
-        "group by 1 "
+        f"and {NOT_PROFILER_SQL}), "
+        "execs as ( "
+        "select QUERY_KEY, count(*) as NUMBER_OF_CALLS, sum(TOTAL_ELAPSED_TIME) / 1000 as TOTAL_TIME_SECONDS "
+        "from history "
+        "group by QUERY_KEY), "
+        "topFrequent as ( "
+        "select QUERY_KEY, rank() over (order by count(*) desc) as FREQUENT_RANK "
+        "from history "
+        "where TOTAL_ELAPSED_TIME > 0 "
+        "group by QUERY_KEY "
         "having count(*) >= 2 "
-        "order by count(*) desc "
-        f"LIMIT {n}) "
-        "select query_text_cut from topFrequent "
-        "where query_text_cut = ?",
-        (queryText,))
-    row = cur.fetchone()
-    if row == None:
-        print(f"It is NOT among the top {n} most frequent queries executed in the last month.")
-        return False
+        f"qualify FREQUENT_RANK <= {n}), "
+        "topRanked as ( "
+        "select QUERY_KEY, "
+        "rank() over (order by avg(TOTAL_ELAPSED_TIME) desc) as LONGEST_RANK, "
+        "rank() over (order by avg(BYTES_SCANNED) desc) as HEAVY_RANK "
+        "from history "
+        "where TOTAL_ELAPSED_TIME > 0 "
+        "and ERROR_CODE is NULL "
+        "and PARTITIONS_SCANNED is not null "
+        "group by QUERY_KEY "
+        f"qualify LONGEST_RANK <= {n} or HEAVY_RANK <= {n}) "
+        "select 'EXECS', QUERY_KEY, NUMBER_OF_CALLS, TOTAL_TIME_SECONDS from execs "
+        "union all select 'FREQUENT', QUERY_KEY, FREQUENT_RANK, null from topFrequent "
+        f"union all select 'LONGEST', QUERY_KEY, LONGEST_RANK, null from topRanked where LONGEST_RANK <= {n} "
+        f"union all select 'HEAVY', QUERY_KEY, HEAVY_RANK, null from topRanked where HEAVY_RANK <= {n}")
+
+    boards = { "FREQUENT": {}, "LONGEST": {}, "HEAVY": {} }
+    execs = {}
+    for row in cur.fetchall():
+        if row[0] == 'EXECS':
+            execs[row[1]] = (int(row[2]), float(row[3]) if row[3] != None else None)
+        else:
+            boards[row[0]][row[1]] = int(row[2])
+    return boards, execs
+
+def getCacheFile(account, role, window = "month"):
+    key = hashlib.sha1(f"{account}|{role}|{window}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"leaderboards-{key}.json")
+
+def loadCache(cacheFile, ttlMinutes = CACHE_TTL_MINUTES):
+    """
+    Returns the cached data, or None when missing or expired
+    """
+    try:
+        with open(cacheFile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cache.get('created', 0) > ttlMinutes * 60:
+        return None
+    # most recently used files are evicted last (unless evicted meanwhile)
+    try:
+        os.utime(cacheFile)
+    except FileNotFoundError:
+        pass
+    return cache.get('data')
+
+def saveCache(cacheFile, data, maxBytes = CACHE_MAX_BYTES):
+    """
+    Save the data, and evict the least recently used cache files above the size limit
+    """
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+    # written to a temporary file, then moved into place, so that no reader ever sees a partial entry
+    tempFile = f"{cacheFile}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tempFile, "w") as f:
+        json.dump({ "created": time.time(), "data": data }, f)
+    os.replace(tempFile, cacheFile)
+
+    # files already evicted (by another process) are skipped
+    with CACHE_LOCK:
+        files = []
+        for file in Path(os.path.dirname(cacheFile)).glob("*.json"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        total = 0
+        for mtime, size, file in sorted(files, key=lambda entry: entry[0], reverse=True):
+            total += size
+            if total > maxBytes and str(file) != cacheFile:
+                try:
+                    file.unlink()
+                except FileNotFoundError:
+                    pass
+
+# rank queries among all those executed in the past month
+def getQueryRanks(queryKeys, cur, cacheFile = None, ttlMinutes = CACHE_TTL_MINUTES):
+    """
+    Returns, for each query key, its number of executions and total time in the past month,
+    with its actual rank among the top most frequent, longest and heaviest queries (None if unranked).
+    With a fresh cache, nothing is computed again: the month-wide leaderboards are cached with the executions
+    of all queries
+    """
+    cached = loadCache(cacheFile, ttlMinutes) if cacheFile != None else None
+    # caches with no executions (of an older version) are computed again too
+    if cached == None or "execs" not in cached:
+        boards, execs = getLeaderboards(cur)
+        if cacheFile != None:
+            saveCache(cacheFile, { "boards": boards, "execs": execs })
     else:
-        print(f"It is among the top {n} most frequent queries executed in the last month.")
-        return True
+        boards, execs = cached["boards"], cached["execs"]
+
+    ranks = {}
+    for key in queryKeys:
+        calls, totalTime = execs.get(key, (0, None))
+        ranks[key] = {
+            "NUMBER_OF_CALLS": calls,
+            "TOTAL_TIME_SECONDS": totalTime,
+            "FREQUENT_RANK": boards['FREQUENT'].get(key),
+            "LONGEST_RANK": boards['LONGEST'].get(key),
+            "HEAVY_RANK": boards['HEAVY'].get(key) }
+    return ranks
+
+def toMirrorTime(dt):
+    # all mirror timestamps are kept as sortable UTC text
+    if dt.tzinfo != None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def openMirror(path):
+    db = sqlite3.connect(path)
+    db.create_function("fingerprint", 1, queryFingerprint, deterministic=True)
+    db.execute(
+        "create table if not exists query_history ( "
+        "QUERY_ID text primary key, QUERY_TEXT text, START_TIME text, "
+        "TOTAL_ELAPSED_TIME integer, BYTES_SCANNED integer, ERROR_CODE text, PARTITIONS_SCANNED integer)")
+
+    # mirrors synced before fingerprints get them now
+    columns = [row[1] for row in db.execute("pragma table_info(query_history)")]
+    if "FINGERPRINT" not in columns:
+        db.execute("alter table query_history add column FINGERPRINT text")
+        db.execute("update query_history set FINGERPRINT = fingerprint(QUERY_TEXT)")
+        db.commit()
+
+    # mirrors synced before baselines have no spill or queued time, and are baselined at the next sync
+    for column in ["BYTES_SPILLED", "QUEUED_TIME"]:
+        if column not in columns:
+            db.execute(f"alter table query_history add column {column} integer")
+    if "BASELINED" not in columns:
+        db.execute("alter table query_history add column BASELINED integer default 0")
+    # and no credits attributed, for the queries synced before
+    for column, type in [("WAREHOUSE_NAME", "text"), ("END_TIME", "text"), ("EXECUTION_START", "text"), ("CREDITS", "real")]:
+        if column not in columns:
+            db.execute(f"alter table query_history add column {column} {type}")
+
+    db.execute("create index if not exists query_history_start_time on query_history (START_TIME)")
+    db.execute("create index if not exists query_history_fingerprint on query_history (FINGERPRINT)")
+    db.execute("create index if not exists query_history_baselined on query_history (START_TIME) where BASELINED = 0")
+    db.execute("create index if not exists query_history_end_time on query_history (END_TIME)")
+    db.execute("create table if not exists mirror_status (NAME text primary key, VALUE text)")
+    db.execute(
+        "create table if not exists baselines ( "
+        "FINGERPRINT text, METRIC text, RUNS integer, SKETCH text, EWMA real, "
+        "primary key (FINGERPRINT, METRIC))")
+    db.execute(
+        "create table if not exists warehouse_metering ( "
+        "WAREHOUSE_NAME text, START_TIME text, END_TIME text, CREDITS real, "
+        "primary key (WAREHOUSE_NAME, START_TIME))")
+    return db
+
+def getMirrorStatus(db):
+    return dict(db.execute("select NAME, VALUE from mirror_status").fetchall())
+
+def syncMirror(db, cur, retentionDays = MIRROR_RETENTION_DAYS):
+    """
+    Incrementally sync the local mirror from ACCOUNT_USAGE.QUERY_HISTORY, from its START_TIME high-watermark,
+    with the metered hours of the warehouses, attribute their credits to the queries synced,
+    and prune the rows older than the retention window
+    """
+    now = datetime.now(timezone.utc)
+    retentionStart = toMirrorTime(now - timedelta(days=retentionDays))
+    watermark = db.execute("select max(START_TIME) from query_history").fetchone()[0]
+    start = (retentionStart if watermark == None
+        else max(retentionStart, toMirrorTime(
+            datetime.strptime(watermark, "%Y-%m-%d %H:%M:%S.%f") - timedelta(hours=MIRROR_SYNC_OVERLAP_HOURS))))
 
-# among top N longest queries?
-def isLongestQuery(queryText, n, cur):
     cur.execute(
-        "with topLongest as ( "
-        "select QUERY_TEXT "
+        "select QUERY_ID, QUERY_TEXT, START_TIME, TOTAL_ELAPSED_TIME, BYTES_SCANNED, ERROR_CODE, PARTITIONS_SCANNED, "
+        "BYTES_SPILLED_TO_LOCAL_STORAGE + BYTES_SPILLED_TO_REMOTE_STORAGE, "
+        "QUEUED_PROVISIONING_TIME + QUEUED_REPAIR_TIME + QUEUED_OVERLOAD_TIME, "
+        "WAREHOUSE_NAME, END_TIME, EXECUTION_TIME "
         "from SNOWFLAKE.ACCOUNT_USAGE.QUERY_HISTORY "
-        "where TO_DATE(START_TIME) > DATEADD(month, -1, TO_DATE(CURRENT_TIMESTAMP())) "
-        "and TOTAL_ELAPSED_TIME > 0 "
-        "and ERROR_CODE iS NULL "
-        "and PARTITIONS_SCANNED is not null "
-        "group by query_text "
-        "order by avg(TOTAL_ELAPSED_TIME) desc "
-        f"LIMIT {n}) "
-        "select query_text from topLongest "
-        "where query_text = ?",
-        (queryText,))
-    row = cur.fetchone()
-    if row == None:
-        print(f"It is NOT among the top {n} longest queries executed in the last month.")
-        return False
-    else:
-        print(f"It is among the top {n} longest queries executed in the last month.")
-        return True
+        f"where START_TIME >= {UTC_TIME_SQL} "
+        f"and {NOT_PROFILER_SQL} "
+        "order by START_TIME, QUERY_ID",
+        (start,))
+
+    changes = db.total_changes
+    while True:
+        rows = cur.fetchmany(10000)
+        if len(rows) == 0:
+            break
+        # rows re-read from the overlap have the same QUERY_ID, and are skipped
+        db.executemany(
+            "insert or ignore into query_history (QUERY_ID, QUERY_TEXT, FINGERPRINT, START_TIME, "
+            "TOTAL_ELAPSED_TIME, BYTES_SCANNED, ERROR_CODE, PARTITIONS_SCANNED, BYTES_SPILLED, QUEUED_TIME, "
+            "WAREHOUSE_NAME, END_TIME, EXECUTION_START) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(row[0], row[1], queryFingerprint(row[1]),
+                toMirrorTime(row[2]), row[3], row[4], row[5], row[6], row[7], row[8], row[9],
+                toMirrorTime(row[10]) if row[10] != None else None,
+                toMirrorTime(row[10] - timedelta(milliseconds=row[11])) if row[10] != None and row[11] != None else None)
+                for row in rows])
+    synced = db.total_changes - changes
+
+    meteringStart = syncMetering(db, cur, retentionStart)
+    attributed = attributeCredits(db, min(start, meteringStart))
+    updateBaselines(db, retentionStart)
+    pruned = db.execute("delete from query_history where START_TIME < ?", (retentionStart,)).rowcount
+    db.execute("delete from warehouse_metering where START_TIME < ?", (retentionStart,))
+    db.execute("insert or replace into mirror_status values ('LAST_SYNC_TIME', ?)", (toMirrorTime(now),))
+    db.commit()
+    return synced, pruned, attributed
+
+def getMirrorSeconds(text):
+    # mirror timestamps (UTC text) as seconds since the epoch
+    return (datetime.fromisoformat(text) - MIRROR_EPOCH).total_seconds()
 
-# among top N with most scanned data?
-def isHeavyQuery(queryText, n, cur):
+def syncMetering(db, cur, retentionStart):
+    """
+    Incrementally sync the hourly compute credits of all warehouses from WAREHOUSE_METERING_HISTORY,
+    re-reading the last hours synced, still revised. Returns the START_TIME synced from
+    """
+    watermark = db.execute("select max(START_TIME) from warehouse_metering").fetchone()[0]
+    start = (retentionStart if watermark == None
+        else max(retentionStart, toMirrorTime(
+            datetime.fromisoformat(watermark) - timedelta(hours=METERING_SYNC_OVERLAP_HOURS))))
     cur.execute(
-        "with topScanned as ( "
-        "select QUERY_TEXT "
-        "from SNOWFLAKE.ACCOUNT_USAGE.QUERY_HISTORY "
-        "where TO_DATE(START_TIME) > DATEADD(month, -1, TO_DATE(CURRENT_TIMESTAMP())) "
-        "and TOTAL_ELAPSED_TIME > 0 "
-        "and ERROR_CODE iS NULL "
-        "and PARTITIONS_SCANNED is not null "
-        "group by query_text "
-        "order by avg(BYTES_SCANNED) desc "
-        f"LIMIT {n}) "
-        "select query_text from topScanned "
-        "where query_text = ?",
-        (queryText,))
-    row = cur.fetchone()
-    if row == None:
-        print(f"It is NOT among the top {n} queries with most data scanned executed in the last month.")
+        "select WAREHOUSE_NAME, START_TIME, END_TIME, CREDITS_USED_COMPUTE "
+        "from SNOWFLAKE.ACCOUNT_USAGE.WAREHOUSE_METERING_HISTORY "
+        f"where START_TIME >= {UTC_TIME_SQL} "
+        "order by START_TIME",
+        (start,))
+    db.executemany("insert or replace into warehouse_metering values (?, ?, ?, ?)",
+        [(row[0], toMirrorTime(row[1]), toMirrorTime(row[2]), float(row[3] or 0)) for row in cur.fetchall()])
+    return start
+
+def attributeCredits(db, start):
+    """
+    Apportion the compute credits of each metered hour of a warehouse to the queries executing in that hour,
+    by their execution time in the hour, again for all the queries running since the start.
+    A sweep line over the execution starts and ends (and the hour boundaries), in time order, sums the
+    execution seconds of each hour. The credits of a query are then the integral, over its execution,
+    of the credits per execution second. Returns the number of queries attributed
+    """
+    # from the metered hour when the earliest query still running at the start began
+    first = db.execute(
+        "select min(EXECUTION_START) from query_history where END_TIME > ? and WAREHOUSE_NAME is not null",
+        (start,)).fetchone()[0]
+    first = min(first or start, start)
+    fromTime = db.execute(
+        "select min(HOUR_START) from (select max(START_TIME) as HOUR_START from warehouse_metering "
+        "where START_TIME <= ? group by WAREHOUSE_NAME)", (first,)).fetchone()[0] or first
+    fromSeconds = getMirrorSeconds(fromTime)
+
+    hours = {}
+    for warehouse, hourStart, hourEnd, credits in db.execute(
+            "select WAREHOUSE_NAME, START_TIME, END_TIME, CREDITS from warehouse_metering "
+            "where START_TIME >= ? order by WAREHOUSE_NAME, START_TIME", (fromTime,)):
+        hours.setdefault(warehouse, []).append((getMirrorSeconds(hourStart), getMirrorSeconds(hourEnd), credits))
+    hourStarts = { warehouse: [hour[0] for hour in rows] for warehouse, rows in hours.items() }
+
+    # sweep line, per warehouse, over the execution starts (+1) and ends (-1), and the hour boundaries (0),
+    # streamed from the mirror in time order: the executions running are the same between two events
+    running = "from query_history where END_TIME > ? and WAREHOUSE_NAME is not null and EXECUTION_START < END_TIME "
+    starts = ((warehouse, max(getMirrorSeconds(time), fromSeconds), 1) for warehouse, time in db.execute(
+        f"select WAREHOUSE_NAME, EXECUTION_START {running}order by WAREHOUSE_NAME, EXECUTION_START", (fromTime,)))
+    ends = ((warehouse, getMirrorSeconds(time), -1) for warehouse, time in db.execute(
+        f"select WAREHOUSE_NAME, END_TIME {running}order by WAREHOUSE_NAME, END_TIME", (fromTime,)))
+    boundaries = ((warehouse, time, 0) for warehouse in sorted(hours) for hour in hours[warehouse] for time in hour[:2])
+    totals = {}
+    warehouse = previous = None
+    active = 0
+    for event in heapq.merge(starts, ends, boundaries):
+        if event[0] != warehouse:
+            warehouse, active = event[0], 0
+        elif active > 0 and event[1] > previous and warehouse in hours:
+            i = bisect.bisect_right(hourStarts[warehouse], previous) - 1
+            if i >= 0 and previous < hours[warehouse][i][1]:
+                totals[(warehouse, i)] = totals.get((warehouse, i), 0) + active * (event[1] - previous)
+        active += event[2]
+        previous = event[1]
+
+    # credits per execution second of each hour, and their integral up to the start of each hour
+    rates = {}
+    integrals = {}
+    for warehouse, rows in hours.items():
+        rates[warehouse] = [credits / totals[(warehouse, i)] if totals.get((warehouse, i), 0) > 0 else 0
+            for i, (hourStart, hourEnd, credits) in enumerate(rows)]
+        integrals[warehouse] = [0]
+        for (hourStart, hourEnd, credits), rate in zip(rows, rates[warehouse]):
+            integrals[warehouse].append(integrals[warehouse][-1] + rate * (hourEnd - hourStart))
+
+    def integral(warehouse, t):
+        i = bisect.bisect_right(hourStarts[warehouse], t) - 1
+        if i < 0:
+            return 0
+        hourStart, hourEnd, credits = hours[warehouse][i]
+        return integrals[warehouse][i] + rates[warehouse][i] * (min(t, hourEnd) - hourStart)
+
+    # credits of the queries started since the first hour, staged first, as the mirror is still read
+    db.execute("create temp table if not exists credits (QUERY_ID text primary key, CREDITS real)")
+    db.execute("delete from credits")
+    rows = db.execute(f"select QUERY_ID, WAREHOUSE_NAME, EXECUTION_START, END_TIME {running}and EXECUTION_START >= ?",
+        (fromTime, fromTime))
+    while True:
+        batch = rows.fetchmany(10000)
+        if len(batch) == 0:
+            break
+        db.executemany("insert into credits values (?, ?)",
+            [(queryId, integral(warehouse, getMirrorSeconds(end)) - integral(warehouse, getMirrorSeconds(executionStart))
+                if warehouse in hours else 0)
+                for queryId, warehouse, executionStart, end in batch])
+    attributed = db.execute(
+        "update query_history set CREDITS = (select CREDITS from credits where credits.QUERY_ID = query_history.QUERY_ID) "
+        "where QUERY_ID in (select QUERY_ID from credits)").rowcount
+    db.execute("delete from credits")
+    return attributed
+
+def getMirrorCredits(queryIds, db):
+    """
+    Compute credits attributed to the queries in the local mirror, by query ID
+    """
+    found = {}
+    for queryId in dict.fromkeys(queryIds):
+        row = db.execute("select CREDITS from query_history where QUERY_ID = ? and CREDITS is not null",
+            (queryId,)).fetchone()
+        if row != None:
+            found[queryId] = row[0]
+    return found
+
+def updateBaselines(db, retentionStart):
+    """
+    Incrementally maintain the baseline of each fingerprint, over the retention window: the runs synced
+    since the last update are added to its sketches (and recent average), in START_TIME order,
+    and the runs about to be pruned are removed from its sketches
+    """
+    metrics = list(BASELINE_METRICS)
+    deltas = {}
+    recent = {}
+    added = db.execute(
+        f"select FINGERPRINT, {', '.join(metrics)} from query_history "
+        "where BASELINED = 0 and START_TIME >= ? "
+        "order by START_TIME", (retentionStart,))
+    removed = db.execute(
+        f"select FINGERPRINT, {', '.join(metrics)} from query_history "
+        "where BASELINED = 1 and START_TIME < ?", (retentionStart,)).fetchall()
+    for rows, sign in [(added.fetchall(), 1), (removed, -1)]:
+        for row in rows:
+            for metric, value in zip(metrics, row[1:]):
+                if value == None:
+                    continue
+                delta = deltas.setdefault((row[0], metric), {})
+                bucket = sketchBucket(value)
+                delta[bucket] = delta.get(bucket, 0) + sign
+                if sign > 0:
+                    recent.setdefault((row[0], metric), []).append(value)
+
+    updates = []
+    for (fingerprint, metric), delta in deltas.items():
+        row = db.execute("select SKETCH, EWMA from baselines where FINGERPRINT = ? and METRIC = ?",
+            (fingerprint, metric)).fetchone()
+        sketch = { int(bucket): count for bucket, count in json.loads(row[0]).items() } if row != None else {}
+        ewma = row[1] if row != None else None
+        for bucket, count in delta.items():
+            sketch[bucket] = sketch.get(bucket, 0) + count
+            if sketch[bucket] <= 0:
+                del sketch[bucket]
+        for value in recent.get((fingerprint, metric), []):
+            ewma = value if ewma == None else ewma + BASELINE_EWMA_ALPHA * (value - ewma)
+        updates.append((fingerprint, metric, sum(sketch.values()), json.dumps(sketch), ewma))
+
+    db.executemany("insert or replace into baselines values (?, ?, ?, ?, ?)", updates)
+    db.execute("delete from baselines where RUNS <= 0")
+    db.execute("update query_history set BASELINED = 1 where BASELINED = 0")
+
+def getBaselines(fingerprints, db):
+    """
+    The baseline of each fingerprint, by metric: number of runs, p50 and p95, and recent average
+    """
+    fingerprints = list(dict.fromkeys(fingerprints))
+    baselines = {}
+    for i in range(0, len(fingerprints), BATCH_SIZE):
+        chunk = fingerprints[i:i + BATCH_SIZE]
+        rows = db.execute(
+            "select FINGERPRINT, METRIC, RUNS, SKETCH, EWMA from baselines "
+            f"where FINGERPRINT in ({', '.join(['?'] * len(chunk))})", tuple(chunk))
+        for fingerprint, metric, runs, sketch, ewma in rows:
+            sketch = { int(bucket): count for bucket, count in json.loads(sketch).items() }
+            baselines.setdefault(fingerprint, {})[metric] = { "runs": runs,
+                "p50": sketchQuantile(sketch, 0.5), "p95": sketchQuantile(sketch, BASELINE_QUANTILE), "recent": ewma }
+    return baselines
+
+def compareBaseline(baseline, props):
+    """
+    Compare the metrics of one run with the baseline of its fingerprint. A run above p95 is a regression,
+    and recent runs well above the median show a shift, e.g. since a change in the data or the query
+    """
+    sumOf = lambda names: None if any(props.get(name) == None for name in names) else sum(props[name] for name in names)
+    values = {
+        "TOTAL_ELAPSED_TIME": props.get('TOTAL_ELAPSED_TIME'),
+        "BYTES_SCANNED": props.get('BYTES_SCANNED'),
+        "BYTES_SPILLED": sumOf(["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"]),
+        "QUEUED_TIME": sumOf(["QUEUED_PROVISIONING_TIME", "QUEUED_REPAIR_TIME", "QUEUED_OVERLOAD_TIME"]) }
+    comparison = {}
+    for metric, stats in baseline.items():
+        value = values.get(metric)
+        enough = stats["runs"] >= BASELINE_MIN_RUNS
+        comparison[metric] = dict(stats, value=value,
+            # above the bucket of p95, as p95 is only the middle of its bucket
+            regression=enough and value != None and value > 0 and sketchBucket(value) > sketchBucket(stats["p95"]),
+            shift=enough and stats["recent"] != None and stats["p50"] > 0
+                and stats["recent"] > THRESHOLDS["BASELINE_SHIFT_RATIO"] * stats["p50"])
+    return comparison
+
+def showBaseline(comparison):
+    runs = max(stats["runs"] for stats in comparison.values())
+    print(f"\nCompared to its {runs:,} runs in the local mirror:")
+    for metric, label in BASELINE_METRICS.items():
+        if metric not in comparison:
+            continue
+        stats = comparison[metric]
+        formatValue = (lambda value: sizeof_fmt(int(value))) if metric.startswith("BYTES") else (lambda value: f"{value:,.0f} ms")
+        value = formatValue(stats["value"]) if stats["value"] != None else "unknown"
+        flags = (["REGRESSION, above p95"] if stats["regression"] else []) + (
+            [f"recent runs shifted to {formatValue(stats['recent'])}"] if stats["shift"] else [])
+        print(f"  {label}: {value}, p50 {formatValue(stats['p50'])}, p95 {formatValue(stats['p95'])}"
+            + (f" ({', '.join(flags)})" if len(flags) > 0 else ""))
+    if runs < BASELINE_MIN_RUNS:
+        print(f"Not enough runs yet (less than {BASELINE_MIN_RUNS}) to tell a regression.")
+
+def showMirrorStatus(db):
+    """
+    Show how fresh the local mirror is, with a warning when it is stale
+    """
+    status = getMirrorStatus(db)
+    if 'LAST_SYNC_TIME' not in status:
+        print("The local mirror of QUERY_HISTORY has never been synced. Run with --sync first.")
         return False
+    count, latest = db.execute("select count(*), max(START_TIME) from query_history").fetchone()
+    lastSync = datetime.strptime(status['LAST_SYNC_TIME'], "%Y-%m-%d %H:%M:%S.%f")
+    age = datetime.now(timezone.utc).replace(tzinfo=None) - lastSync
+    print(f"Rankings computed from the local mirror of {count:,} queries, "
+        f"last synced {int(age.total_seconds() // 60):,} minutes ago (latest query started at {latest} UTC).")
+    if age > timedelta(hours=MIRROR_STALE_HOURS):
+        print(f"The local mirror is more than {MIRROR_STALE_HOURS} hours old. Run with --sync to refresh it.")
+    return True
+
+def getMirrorRanks(fingerprints, db):
+    """
+    Same as getQueryRanks, but computed locally, from the mirror of QUERY_HISTORY, by query fingerprint,
+    with also the compute credits attributed to its runs, and its rank among the most expensive queries
+    """
+    fingerprints = list(dict.fromkeys(fingerprints))
+    rows = db.execute(
+        "with history as ( "
+        "select FINGERPRINT, TOTAL_ELAPSED_TIME, BYTES_SCANNED, ERROR_CODE, PARTITIONS_SCANNED, CREDITS "
+        "from query_history "
+        "where date(START_TIME) > date('now', '-1 month')), "
+        # all fingerprints as one JSON array, since compound selects and bound parameters are limited in number
+        "targets as (select value as FINGERPRINT from json_each(?)), "
+        "execs as ( "
+        "select FINGERPRINT, count(*) as NUMBER_OF_CALLS, sum(TOTAL_ELAPSED_TIME) / 1000.0 as TOTAL_TIME_SECONDS, "
+        "sum(CREDITS) as TOTAL_CREDITS "
+        "from history "
+        "where FINGERPRINT in (select FINGERPRINT from targets) "
+        "group by FINGERPRINT), "
+        "topFrequent as ( "
+        "select FINGERPRINT, rank() over (order by count(*) desc) as FREQUENT_RANK "
+        "from history "
+        "where TOTAL_ELAPSED_TIME > 0 "
+        "group by FINGERPRINT "
+        "having count(*) >= 2), "
+        "topRanked as ( "
+        "select FINGERPRINT, "
+        "rank() over (order by avg(TOTAL_ELAPSED_TIME) desc) as LONGEST_RANK, "
+        "rank() over (order by avg(BYTES_SCANNED) desc) as HEAVY_RANK "
+        "from history "
+        "where TOTAL_ELAPSED_TIME > 0 "
+        "and ERROR_CODE is NULL "
+        "and PARTITIONS_SCANNED is not null "
+        "group by FINGERPRINT), "
+        "topExpensive as ( "
+        "select FINGERPRINT, rank() over (order by sum(CREDITS) desc) as EXPENSIVE_RANK "
+        "from history "
+        "where CREDITS > 0 "
+        "group by FINGERPRINT) "
+        "select t.FINGERPRINT, coalesce(e.NUMBER_OF_CALLS, 0), e.TOTAL_TIME_SECONDS, "
+        "f.FREQUENT_RANK, r.LONGEST_RANK, r.HEAVY_RANK, e.TOTAL_CREDITS, x.EXPENSIVE_RANK "
+        "from targets t "
+        "left join execs e on e.FINGERPRINT = t.FINGERPRINT "
+        "left join topFrequent f on f.FINGERPRINT = t.FINGERPRINT "
+        "left join topRanked r on r.FINGERPRINT = t.FINGERPRINT "
+        "left join topExpensive x on x.FINGERPRINT = t.FINGERPRINT",
+        (json.dumps(fingerprints),)).fetchall()
+
+    ranks = {}
+    for row in rows:
+        ranks[row[0]] = {
+            "NUMBER_OF_CALLS": int(row[1]),
+            "TOTAL_TIME_SECONDS": row[2],
+            "FREQUENT_RANK": row[3],
+            "LONGEST_RANK": row[4],
+            "HEAVY_RANK": row[5],
+            "TOTAL_CREDITS": row[6],
+            "EXPENSIVE_RANK": row[7] }
+    return ranks
+
+def getMirrorStartTimes(queryIds, db):
+    """
+    START_TIME of the queries already in the local mirror, by query ID, as hints for their lookup
+    """
+    found = {}
+    for queryId in dict.fromkeys(queryIds):
+        row = db.execute("select START_TIME from query_history where QUERY_ID = ?", (queryId,)).fetchone()
+        if row != None:
+            found[queryId] = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=timezone.utc)
+    return found
+
+def findMirrorQueryIds(queryTexts, db):
+    """
+    Most recent query ID for each query text, matched by fingerprint in the local mirror
+    """
+    found = {}
+    for queryText in queryTexts:
+        row = db.execute(
+            "select QUERY_ID from query_history "
+            "where FINGERPRINT = ? "
+            "order by START_TIME desc limit 1",
+            (queryFingerprint(queryText),)).fetchone()
+        if row != None:
+            found[queryText] = row[0]
+    return found
+
+# among top N (10 or 100) queries?
+def showRank(rank, description, tops = (10, 100)):
+    for n in tops:
+        if rank != None and rank <= n:
+            print(f"It is among the top {n} {description} executed in the last month (ranked #{rank}).")
+            return True
+    print(f"It is NOT among the top {tops[-1]} {description} executed in the last month.")
+    return False
+
+def showQueryRanks(ranks):
+    # check number of calls in the past month
+    if ranks['NUMBER_OF_CALLS'] == 0:
+        print("It has not been executed at all in the last month.")
     else:
-        print(f"It is among the top {n} queries queries with most data scanned executed in the last month.")
-        return True
+        print(f"It has been executed {ranks['NUMBER_OF_CALLS']} times in the last month, "
+            f"for a total of {ranks['TOTAL_TIME_SECONDS']} seconds.")
+    if ranks['NUMBER_OF_CALLS'] > 1:
+        showRank(ranks['FREQUENT_RANK'], "most frequent queries", (10,))
+
+    # among top 10 or 100 longest queries?
+    showRank(ranks['LONGEST_RANK'], "longest queries")
+
+    # among top 10 or 100 with most scanned data?
+    showRank(ranks['HEAVY_RANK'], "queries with most data scanned")
+
+    # among top 10 or 100 with most compute credits? (from the local mirror only)
+    if 'EXPENSIVE_RANK' in ranks:
+        if ranks['TOTAL_CREDITS'] != None:
+            print(f"Its runs used an estimated {ranks['TOTAL_CREDITS']:,.4f} compute credits in the last month.")
+        showRank(ranks['EXPENSIVE_RANK'], "queries with most compute credits")
+
+# hints, as declarative rules evaluated column-wise, over one query (scalars) or many (numpy arrays).
+# Within a group, only the first rule matched fires. Only rules with a label are flagged in the workload
+RULES = [
+    { "name": "queued-provisioning", "section": "queued", "columns": ["QUEUED_PROVISIONING_TIME"],
+        "label": "queued provisioning",
+        "when": lambda c, t: c["QUEUED_PROVISIONING_TIME"] > 0,
+        "message": lambda p, t:
+            f"\nThe query has been queued for {p['QUEUED_PROVISIONING_TIME']} ms, "
+            f"waiting for the warehouse to provision, due to the warehouse creation, resume, or resize." },
+    { "name": "queued-repair", "section": "queued", "columns": ["QUEUED_REPAIR_TIME"],
+        "label": "queued repair",
+        "when": lambda c, t: c["QUEUED_REPAIR_TIME"] > 0,
+        "message": lambda p, t:
+            f"\nThe query has been queued for {p['QUEUED_REPAIR_TIME']} ms, "
+            f"waiting for compute resources in the warehouse to be repaired." },
+    { "name": "queued-overload", "section": "queued", "columns": ["QUEUED_OVERLOAD_TIME"],
+        "label": "queued overload",
+        "when": lambda c, t: c["QUEUED_OVERLOAD_TIME"] > 0,
+        "message": lambda p, t:
+            f"\nThe query has been queued for {p['QUEUED_OVERLOAD_TIME']} ms, "
+            f"due to the warehouse being overloaded by the current query workload." },
+    { "name": "transaction-blocked", "section": "queued", "columns": ["TRANSACTION_BLOCKED_TIME"],
+        "label": "blocked transactions",
+        "when": lambda c, t: c["TRANSACTION_BLOCKED_TIME"] > 0,
+        "message": lambda p, t:
+            f"\nThe query has been blocked for {p['TRANSACTION_BLOCKED_TIME']} ms by transactions." },
+
+    { "name": "spill-local-high", "section": "spill", "group": "spill-local", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "label": "local spilling",
+        "operators": ("bytesSpilledLocal", "It spilled to local storage in:"),
+        "when": lambda c, t: c["BYTES_SPILLED_TO_LOCAL_STORAGE"] >= t["SPILL_BYTES"],
+        "message": lambda p, t:
+            f"\nOver {t['SPILL_BYTES'] / 1000000:g}MB - {sizeof_fmt(p['BYTES_SPILLED_TO_LOCAL_STORAGE'])} - spilled to local storage. "
+            "\nThis could mean that your warehouse nodes do not have enough RAM. "
+            "They have to do swap with the local SSD disk too frequently. "
+            "\nHint: You may need a larger warehouse." },
+    { "name": "spill-local-none", "section": "spill", "group": "spill-local", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "when": lambda c, t: c["BYTES_SPILLED_TO_LOCAL_STORAGE"] == 0,
+        "message": lambda p, t:
+            "\nNothing spilled to local storage, which is good. "
+            "\nThis often means that the warehouse node(s) had enough memory to process it all in RAM." },
+    { "name": "spill-local", "section": "spill", "group": "spill-local", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "when": lambda c, t: c["BYTES_SPILLED_TO_LOCAL_STORAGE"] > 0,
+        "message": lambda p, t:
+            f"\n{sizeof_fmt(p['BYTES_SPILLED_TO_LOCAL_STORAGE'])} spilled to local storage." },
+    { "name": "spill-remote-high", "section": "spill", "group": "spill-remote", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "label": "remote spilling",
+        "operators": ("bytesSpilledRemote", "It spilled to remote storage in:"),
+        "when": lambda c, t: c["BYTES_SPILLED_TO_REMOTE_STORAGE"] >= t["SPILL_BYTES"],
+        "message": lambda p, t:
+            f"\nOver {t['SPILL_BYTES'] / 1000000:g}MB - {sizeof_fmt(p['BYTES_SPILLED_TO_REMOTE_STORAGE'])} - spilled to remote storage. "
+            "\nThis could mean that your warehouse nodes do not have large enough SSD disks. "
+            "The query had to access way to frequently the remote S3 or Azure Blog storage. "
+            "\nYou may need a larger warehouse." },
+    { "name": "spill-remote-none", "section": "spill", "group": "spill-remote", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "when": lambda c, t: c["BYTES_SPILLED_TO_REMOTE_STORAGE"] == 0,
+        "message": lambda p, t:
+            "\nNothing spilled to remote storage, which is good. "
+            "\nThis often means that the warehouse node(s) had enough RAM and SSD disk space to process it all locally." },
+    { "name": "spill-remote", "section": "spill", "group": "spill-remote", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "when": lambda c, t: c["BYTES_SPILLED_TO_REMOTE_STORAGE"] > 0,
+        "message": lambda p, t:
+            f"\n{sizeof_fmt(p['BYTES_SPILLED_TO_REMOTE_STORAGE'])} spilled to remote storage." },
+    { "name": "spill-see", "section": "spill", "accountUsage": True,
+        "columns": ["BYTES_SPILLED_TO_LOCAL_STORAGE", "BYTES_SPILLED_TO_REMOTE_STORAGE"],
+        "when": lambda c, t: c["BYTES_SPILLED_TO_LOCAL_STORAGE"] >= 0,
+        "message": lambda p, t:
+            "See https://community.snowflake.com/s/article/Performance-impact-from-local-and-remote-disk-spilling." },
+
+    { "name": "scan", "section": "scan", "columns": ["BYTES_SCANNED"],
+        "when": lambda c, t: c["BYTES_SCANNED"] >= 0,
+        "message": lambda p, t:
+            f"\nThe query scanned a total of {sizeof_fmt(p['BYTES_SCANNED'])}." },
+    { "name": "scan-high", "section": "scan", "columns": ["BYTES_SCANNED"],
+        "label": "large scans",
+        "when": lambda c, t: c["BYTES_SCANNED"] > t["SCAN_BYTES"],
+        "message": lambda p, t:
+            "Hint: Consider reducing the amount of data a query needs to read from the tables." },
+
+    { "name": "cache-all", "section": "cache", "group": "cache", "accountUsage": True,
+        "columns": ["PERCENTAGE_SCANNED_FROM_CACHE"],
+        "when": lambda c, t: c["PERCENTAGE_SCANNED_FROM_CACHE"] == 1.0,
+        "message": lambda p, t:
+            "\nAll your data has been served from the result cache, "
+            "so the query did not execute again, and did not consume any compute resources. "
+            "\nThis is great! The query result will still be here for at least 24 hours."
+            "\nSee https://community.snowflake.com/s/article/Understanding-Result-Caching." },
+    { "name": "cache-high", "section": "cache", "group": "cache", "accountUsage": True,
+        "columns": ["PERCENTAGE_SCANNED_FROM_CACHE"],
+        "when": lambda c, t: c["PERCENTAGE_SCANNED_FROM_CACHE"] > t["CACHE_HIGH_RATIO"],
+        "message": lambda p, t:
+            f"\nMore than {t['CACHE_HIGH_RATIO']:.0%} ({p['PERCENTAGE_SCANNED_FROM_CACHE']}) of your data has been found in the result cache. "
+            "This is good." },
+    { "name": "cache-low", "section": "cache", "group": "cache", "accountUsage": True,
+        "columns": ["PERCENTAGE_SCANNED_FROM_CACHE"],
+        "label": "low cache",
+        "when": lambda c, t: c["PERCENTAGE_SCANNED_FROM_CACHE"] < t["CACHE_LOW_RATIO"],
+        "message": lambda p, t:
+            f"\nLess than {t['CACHE_LOW_RATIO']:.0%} ({p['PERCENTAGE_SCANNED_FROM_CACHE']}) of your data has been found in the result cache. "
+            "\nHint: Look for consecutive queries that could use the query result cache."
+            "\nSee https://community.snowflake.com/s/article/Understanding-Result-Caching." },
+    { "name": "cache", "section": "cache", "group": "cache", "accountUsage": True,
+        "columns": ["PERCENTAGE_SCANNED_FROM_CACHE"],
+        "when": lambda c, t: c["PERCENTAGE_SCANNED_FROM_CACHE"] >= 0,
+        "message": lambda p, t:
+            f"\n{p['PERCENTAGE_SCANNED_FROM_CACHE']} of your data has been found in the result cache."
+            "\nSee https://community.snowflake.com/s/article/Understanding-Result-Caching for more info." },
+
+    { "name": "pruning-full", "section": "pruning", "group": "pruning", "accountUsage": True,
+        "columns": ["PARTITIONS_SCANNED", "PARTITIONS_TOTAL"],
+        "label": "full scans",
+        "when": lambda c, t: (c["PARTITIONS_TOTAL"] > 0) & (c["PARTITIONS_SCANNED"] == c["PARTITIONS_TOTAL"]),
+        "message": lambda p, t:
+            f"\nYou had a full table scan, for all {p['PARTITIONS_TOTAL']:,} partitions. "
+            "\nHint: Consider improving partition pruning, by eventually adding some cluster key, or a filter." },
+    { "name": "pruning-efficient", "section": "pruning", "group": "pruning", "accountUsage": True,
+        "columns": ["PARTITIONS_SCANNED", "PARTITIONS_TOTAL"],
+        "when": lambda c, t: (c["PARTITIONS_TOTAL"] > 0) & (c["PARTITIONS_SCANNED"] <= t["PRUNING_RATIO"] * c["PARTITIONS_TOTAL"]),
+        "message": lambda p, t:
+            f"\n{p['PARTITIONS_SCANNED']:,} partitions out of a total of {p['PARTITIONS_TOTAL']:,} have been scanned. "
+            "\nPartition pruning (and your current cluster keys) seem efficient for this query." },
+    { "name": "pruning-poor", "section": "pruning", "group": "pruning", "accountUsage": True,
+        "columns": ["PARTITIONS_SCANNED", "PARTITIONS_TOTAL"],
+        "label": "poor pruning",
+        "when": lambda c, t: c["PARTITIONS_TOTAL"] > 0,
+        "message": lambda p, t:
+            f"\n{p['PARTITIONS_SCANNED']:,} partitions out of a total of {p['PARTITIONS_TOTAL']:,} have been scanned. "
+            "\nHint: Consider improving partition pruning, by eventually adding some cluster key, or a filter." },
+    { "name": "pruning-see", "section": "pruning", "accountUsage": True,
+        "columns": ["PARTITIONS_SCANNED", "PARTITIONS_TOTAL"],
+        "when": lambda c, t: c["PARTITIONS_TOTAL"] > 0,
+        "message": lambda p, t:
+            "See https://community.snowflake.com/s/article/How-to-recognize-unsatisfactory-pruning." },
+]
 
-def showQueryHistory(props, isAccountUsage, cur):
+# the queries profiled in the watch mode, as they complete. Spilling and partitions are not in
+# INFORMATION_SCHEMA.QUERY_HISTORY, so only the metrics of both schemas can be watched
+WATCH_RULES = [
+    { "name": "watch-slow", "label": "slow", "columns": ["TOTAL_ELAPSED_TIME"],
+        "when": lambda c, t: c["TOTAL_ELAPSED_TIME"] >= t["WATCH_ELAPSED_MS"] },
+]
+
+def evaluateRules(columns, isAccountUsage = True, rules = None, thresholds = None):
+    """
+    Evaluate all rules column-wise, over a pandas DataFrame (or dict of numpy arrays) of QUERY_HISTORY rows,
+    or over a dict of scalars, for a single query. Returns the mask of each rule, by name
+    """
+    rules = RULES if rules == None else rules
+    thresholds = THRESHOLDS if thresholds == None else thresholds
+    fired = {}
+    matched = {}
+    for rule in rules:
+        if rule.get("accountUsage", False) and not isAccountUsage:
+            continue
+        if any(column not in columns for column in rule["columns"]):
+            continue
+        mask = rule["when"](columns, thresholds)
+        group = rule.get("group")
+        if group != None:
+            if group in matched:
+                mask = mask & (matched[group] == False)
+                matched[group] = matched[group] | mask
+            else:
+                matched[group] = mask
+        fired[rule["name"]] = mask
+    return fired
+
+def toColumns(props):
+    # numeric metrics of a single query, as scalars for evaluateRules
+    return { key: float(value) for key, value in props.items()
+        if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) }
+
+def getRuleLabels(fired):
+    return [rule["label"] for rule in RULES if "label" in rule and rule["name"] in fired and fired[rule["name"]]]
+
+def getHints(props, isAccountUsage, plan = None):
+    """
+    The hints fired for one query, in display order, each with its rule name, section, label and message.
+    Partition pruning is hinted per table, when known from the EXPLAIN plan
+    """
+    fired = evaluateRules(toColumns(props), isAccountUsage)
+    hints = [{ "name": rule["name"], "section": rule["section"], "label": rule.get("label"),
+            "message": rule["message"](props, THRESHOLDS) }
+        for rule in RULES if rule["name"] in fired and fired[rule["name"]]]
+
+    tableScans = [node for node in getTableScans(plan) if node['partitionsTotal']] if plan != None else []
+    if len(tableScans) > 0:
+        hints = [hint for hint in hints if hint["section"] != "pruning"]
+        for node in tableScans:
+            table = ", ".join(node['objects'])
+            if node['partitionsAssigned'] == node['partitionsTotal']:
+                hint = { "name": "table-pruning-full", "label": "full scans", "message":
+                    f"\nYou had a full table scan on {table}, for all {node['partitionsTotal']:,} partitions. "
+                    f"\nHint: Consider improving partition pruning on {table}, by eventually adding some cluster key, or a filter." }
+            elif node['partitionsAssigned'] <= THRESHOLDS["PRUNING_RATIO"] * node['partitionsTotal']:
+                hint = { "name": "table-pruning-efficient", "label": None, "message":
+                    f"\n{node['partitionsAssigned']:,} partitions out of a total of {node['partitionsTotal']:,} will be scanned on {table}. "
+                    "\nPartition pruning (and your current cluster keys) seem efficient for this table." }
+            else:
+                hint = { "name": "table-pruning-poor", "label": "poor pruning", "message":
+                    f"\n{node['partitionsAssigned']:,} partitions out of a total of {node['partitionsTotal']:,} will be scanned on {table}. "
+                    f"\nHint: Consider improving partition pruning on {table}, by eventually adding some cluster key, or a filter." }
+            hints.append(dict(hint, section="pruning", table=table))
+        hints.append({ "name": "pruning-see", "section": "pruning", "label": None,
+            "message": "See https://community.snowflake.com/s/article/How-to-recognize-unsatisfactory-pruning." })
+    return hints
+
+def showHints(section, hints, operators = None):
+    rules = { rule["name"]: rule for rule in RULES }
+    for hint in hints:
+        if hint["section"] == section:
+            print(hint["message"])
+            if hint["name"] in rules and "operators" in rules[hint["name"]]:
+                showFlaggedOperators(operators, *rules[hint["name"]]["operators"])
+
+def showQueryHistory(profile):
     """
     Display info from QUERY_HISTORY, from either ACCOUNT_USAGE or INFORMATION_SCHEMA
     """
+    props = profile['metrics']
+    isAccountUsage = profile['isAccountUsage']
+    operators = profile['operators']
 
     # query SQL statement and ID
     print("=========================================================")
@@ -139,20 +1066,12 @@ def showQueryHistory(props, isAccountUsage, cur):
             f"+ it executed in {props['EXECUTION_TIME']:,} ms.")
         print(f"The query run between {props['START_TIME']} and {props['END_TIME']}.")
 
-        if isAccountUsage:
+        if isAccountUsage and profile['ranks'] != None:
             print()
+            showQueryRanks(profile['ranks'])
 
-            # check number of calls in the past month
-            if checkExecNumber(queryText, cur) > 1:
-                isFrequentQuery(queryText, 10, cur)
-
-            # among top 10 or 100 longest queries?
-            if isLongestQuery(queryText, 10, cur) == False:
-                isLongestQuery(queryText, 100, cur)
-
-            # among top 10 or 100 with most scanned data?
-            if isHeavyQuery(queryText, 10, cur) == False:
-                isHeavyQuery(queryText, 100, cur)
+        if profile['baseline'] != None:
+            showBaseline(profile['baseline'])
 
     # user/role/database/schema context
     print(f"\nThe query was executed by the {props['USER_NAME']} user, using the {props['ROLE_NAME']} role.")
@@ -170,10 +1089,17 @@ def showQueryHistory(props, isAccountUsage, cur):
     nodes = (f"with {props['CLUSTER_NUMBER']} nodes, "
         if props['CLUSTER_NUMBER'] != None
         else "")
+    wh_type = (f"{props['WAREHOUSE_TYPE'].lower()} "
+        if props['WAREHOUSE_TYPE'] != None
+        else "")
     print(
         f"The query used the {wh_size}{props['WAREHOUSE_NAME']} "
-        f"{props['WAREHOUSE_TYPE'].lower()} warehouse, {nodes}{load_percent}"
+        f"{wh_type}warehouse, {nodes}{load_percent}"
         f"with {props['CREDITS_USED_CLOUD_SERVICES']} cloud compute credits.")
+    if profile['cost'] != None:
+        cost = profile['cost']
+        print(f"Its share of the metered warehouse hours is an estimated {cost['credits']:.6f} compute credits "
+            f"(about ${cost['dollars']:,.4f}, at ${cost['creditPrice']:,.2f} per credit).")
 
     # results
     if props['ROWS_PRODUCED'] == None:
@@ -190,105 +1116,42 @@ def showQueryHistory(props, isAccountUsage, cur):
     if isAccountUsage and 'ROWS_UNLOADED' in props and int(props['ROWS_UNLOADED']) > 0:
         print(f"{props['ROWS_UNLOADED']} rows have been unloaded.")
 
-    # query queued
-    if int(props["QUEUED_PROVISIONING_TIME"]) > 0:
-        print(
-            f"\nThe query has been queued for {props['QUEUED_PROVISIONING_TIME']} ms, "
-            f"waiting for the warehouse to provision, due to the warehouse creation, resume, or resize.")
-    if int(props["QUEUED_REPAIR_TIME"]) > 0:
-        print(
-            f"\nThe query has been queued for {props['QUEUED_REPAIR_TIME']} ms, "
-            f"waiting for compute resources in the warehouse to be repaired.")
-    if int(props["QUEUED_OVERLOAD_TIME"]) > 0:
-        print(
-            f"\nThe query has been queued for {props['QUEUED_OVERLOAD_TIME']} ms, "
-            f"due to the warehouse being overloaded by the current query workload.")
+    if len(profile['estimated']) > 0:
+        print(f"\nEstimated from the EXPLAIN plan, not measured: {', '.join(profile['estimated'])}.")
 
-    if int(props["TRANSACTION_BLOCKED_TIME"]) > 0:
-        print(f"\nThe query has been blocked for {props['TRANSACTION_BLOCKED_TIME']} ms by transactions.")
+    # query queued, and what it competed with on the warehouse
+    showHints("queued", profile['hints'])
+    if profile['contention'] != None:
+        showContention(profile['contention'])
 
     # bytes spilled
-    if isAccountUsage and 'BYTES_SPILLED_TO_LOCAL_STORAGE' in props:
-        if int(props["BYTES_SPILLED_TO_LOCAL_STORAGE"]) >= 1000000:
-            print(
-                f"\nOver 1MB - {sizeof_fmt(props['BYTES_SPILLED_TO_LOCAL_STORAGE'])} - spilled to local storage. "
-                "\nThis could mean that your warehouse nodes do not have enough RAM. "
-                "They have to do swap with the local SSD disk too frequently. "
-                "\nHint: You may need a larger warehouse.")
-        elif int(props["BYTES_SPILLED_TO_LOCAL_STORAGE"]) == 0:
-            print("\nNothing spilled to local storage, which is good. "
-            "\nThis often means that the warehouse node(s) had enough memory to process it all in RAM.")
-        else:
-            print(f"\n{sizeof_fmt(props['BYTES_SPILLED_TO_LOCAL_STORAGE'])} spilled to local storage.")
-
-        if int(props["BYTES_SPILLED_TO_REMOTE_STORAGE"]) >= 1000000:
-            print(
-                f"\nOver 1MB - {sizeof_fmt(props['BYTES_SPILLED_TO_REMOTE_STORAGE'])} - spilled to remote storage. "
-                "\nThis could mean that your warehouse nodes do not have large enough SSD disks. "
-                "The query had to access way to frequently the remote S3 or Azure Blog storage. "
-                "\nYou may need a larger warehouse.")
-        elif int(props["BYTES_SPILLED_TO_REMOTE_STORAGE"]) == 0:
-            print("\nNothing spilled to remote storage, which is good. "
-            "\nThis often means that the warehouse node(s) had enough RAM and SSD disk space to process it all locally.")
-        else:
-            print(f"\n{sizeof_fmt(props['BYTES_SPILLED_TO_REMOTE_STORAGE'])} spilled to remote storage.")
-        print("See https://community.snowflake.com/s/article/Performance-impact-from-local-and-remote-disk-spilling.")
+    showHints("spill", profile['hints'], operators)
 
     # bytes scanned
-    print(f"\nThe query scanned a total of {sizeof_fmt(props['BYTES_SCANNED'])}.")
-    if int(props['BYTES_SCANNED']) > 10000000:
-        print("Hint: Consider reducing the amount of data a query needs to read from the tables.")
-        #print("See .")
+    showHints("scan", profile['hints'])
 
     # caching
-    if isAccountUsage and 'PERCENTAGE_SCANNED_FROM_CACHE' in props:
-        if float(props['PERCENTAGE_SCANNED_FROM_CACHE']) == 1.0:
-            print(
-                "\nAll your data has been served from the result cache, "
-                "so the query did not execute again, and did not consume any compute resources. "
-                "\nThis is great! The query result will still be here for at least 24 hours."
-                "\nSee https://community.snowflake.com/s/article/Understanding-Result-Caching.")
-        elif float(props['PERCENTAGE_SCANNED_FROM_CACHE']) > 0.8:
-            print(
-                f"\nMore than 80% ({props['PERCENTAGE_SCANNED_FROM_CACHE']}) of your data has been found in the result cache. "
-                "This is good.")
-        elif float(props['PERCENTAGE_SCANNED_FROM_CACHE']) < 0.5:
-            print(
-                f"\nLess than 5% ({props['PERCENTAGE_SCANNED_FROM_CACHE']}) of your data has been found in the result cache. "
-                "\nHint: Look for consecutive queries that could use the query result cache."
-                "\nSee https://community.snowflake.com/s/article/Understanding-Result-Caching.")
-        else:
-            print(
-                f"\n{props['PERCENTAGE_SCANNED_FROM_CACHE']} of your data has been found in the result cache."
-                "\nSee https://community.snowflake.com/s/article/Understanding-Result-Caching for more info.")
-
-    # partitions and pruning
-    if isAccountUsage and 'PARTITIONS_TOTAL' in props and int(props['PARTITIONS_TOTAL']) > 0:
-        if int(props['PARTITIONS_SCANNED']) == int(props['PARTITIONS_TOTAL']):
-            print(
-                f"\nYou had a full table scan, for all {props['PARTITIONS_TOTAL']:,} partitions. "
-                "\nHint: Consider improving partition pruning, by eventually adding some cluster key, or a filter.")
-        elif int(props['PARTITIONS_SCANNED']) <= 0.2 * int(props['PARTITIONS_TOTAL']):
-            print(
-                f"\n{props['PARTITIONS_SCANNED']:,} partitions out of a total of {props['PARTITIONS_TOTAL']:,} have been scanned. "
-                "\nPartition pruning (and your current cluster keys) seem efficient for this query.")
-        else:
-            print(
-                f"\n{props['PARTITIONS_SCANNED']:,} partitions out of a total of {props['PARTITIONS_TOTAL']:,} have been scanned. "
-                "\nHint: Consider improving partition pruning, by eventually adding some cluster key, or a filter.")
+    showHints("cache", profile['hints'])
 
-        print("See https://community.snowflake.com/s/article/How-to-recognize-unsatisfactory-pruning.")
+    # partitions and pruning, per table when known from the EXPLAIN plan
+    showHints("pruning", profile['hints'])
+    # operators, from their actual execution
+    if operators != None and len(operators['operators']) > 0:
+        showFlaggedOperators(operators, "poorPruning", "\nPartition pruning was poor in:")
+        showFlaggedOperators(operators, "explodingJoin",
+            f"\nJoins producing over {THRESHOLDS['JOIN_EXPLOSION_FACTOR']:g} times more rows than they received:")
+        showOperators(operators)
 
     # inbound/outbound
     if int(props['INBOUND_DATA_TRANSFER_BYTES']) > 0:
         print(
             f"\nThe query received {sizeof_fmt(props['INBOUND_DATA_TRANSFER_BYTES'])} "
-            f"from the {props['INBOUND_DATA_TRANSFER_CLOUD=None']} inbound acount, "
+            f"from the {props['INBOUND_DATA_TRANSFER_CLOUD']} inbound acount, "
             f"in the {props['INBOUND_DATA_TRANSFER_REGION']} region.")
     if int(props['OUTBOUND_DATA_TRANSFER_BYTES']) > 0:
         print(
             f"\nThe query sent {sizeof_fmt(props['OUTBOUND_DATA_TRANSFER_BYTES'])} "
-            f"to the {props['OUTBOUND_DATA_TRANSFER_CLOUD=None']} outbound acount, "
+            f"to the {props['OUTBOUND_DATA_TRANSFER_CLOUD']} outbound acount, "
             f"in the {props['OUTBOUND_DATA_TRANSFER_REGION']} region.")
 
     # external functions
@@ -299,6 +1162,20 @@ def showQueryHistory(props, isAccountUsage, cur):
             f"\n{sizeof_fmt(props['EXTERNAL_FUNCTION_TOTAL_SENT_BYTES'])} have been send, {sizeof_fmt(props['EXTERNAL_FUNCTION_TOTAL_RECEIVED_BYTES'])} received.")
 
 
+# the private key is read and serialized only once per process
+@functools.lru_cache(maxsize=None)
+def readPrivateKey(path):
+    with open(path, "rb") as key:
+        p_key= serialization.load_pem_private_key(
+            key.read(),
+            password = None, # os.environ['SNOWFLAKE_PASSPHRASE'].encode(),
+            backend = default_backend()
+        )
+    return p_key.private_bytes(
+        encoding = serialization.Encoding.DER,
+        format = serialization.PrivateFormat.PKCS8,
+        encryption_algorithm = serialization.NoEncryption())
+
 def connect(connect_mode, account, user, role, warehouse, database, schema):
 
     # (a) connect to Snowflake with SSO
@@ -311,7 +1188,8 @@ def connect(connect_mode, account, user, role, warehouse, database, schema):
             schema = schema,
             warehouse = warehouse,
             authenticator = "externalbrowser",
-            paramstyle = 'qmark'
+            paramstyle = 'qmark',
+            session_parameters = { "QUERY_TAG": PROFILER_QUERY_TAG }
         )
 
     # (b) connect to Snowflake with username/password
@@ -324,22 +1202,13 @@ def connect(connect_mode, account, user, role, warehouse, database, schema):
             schema = schema,
             warehouse = warehouse,
             password = os.getenv('SNOWFLAKE_PASSWORD'),
-            paramstyle = 'qmark'
+            paramstyle = 'qmark',
+            session_parameters = { "QUERY_TAG": PROFILER_QUERY_TAG }
         )
 
     # (c) connect to Snowflake with key-pair
     if connect_mode == "KEY-PAIR":
-        with open(f"{str(Path.home())}/.ssh/id_rsa_snowflake_demo", "rb") as key:
-            p_key= serialization.load_pem_private_key(
-                key.read(),
-                password = None, # os.environ['SNOWFLAKE_PASSPHRASE'].encode(),
-                backend = default_backend()
-            )
-        pkb = p_key.private_bytes(
-            encoding = serialization.Encoding.DER,
-            format = serialization.PrivateFormat.PKCS8,
-            encryption_algorithm = serialization.NoEncryption())
-
+        pkb = readPrivateKey(f"{str(Path.home())}/.ssh/id_rsa_snowflake_demo")
         return snowflake.connector.connect(
             account = account,
             user = user,
@@ -348,153 +1217,1733 @@ def connect(connect_mode, account, user, role, warehouse, database, schema):
             schema = schema,
             warehouse = warehouse,
             private_key = pkb,
-            paramstyle = 'qmark'
+            paramstyle = 'qmark',
+            session_parameters = { "QUERY_TAG": PROFILER_QUERY_TAG }
         )
 
-def main():
+def toFixtureValue(value):
+    # column values of the recorded rows, as JSON that can be read back with the same types
+    if isinstance(value, datetime):
+        return { "$datetime": value.isoformat() }
+    if isinstance(value, Decimal):
+        return { "$decimal": str(value) }
+    return value
+
+def fromFixtureValue(value):
+    if isinstance(value, dict) and "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    if isinstance(value, dict) and "$decimal" in value:
+        return Decimal(value["$decimal"])
+    return value
+
+class FixtureCursor:
     """
-    Main entry point of the CLI
+    Cursor serving the rows of one statement at a time, recorded or replayed, with the statements
+    issued and rows fetched counted on its connection
     """
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rows = []
+
+    def serve(self, names, rows):
+        self.description = [(name, None, None, None, None, None, True) for name in names] if names != None else None
+        self.rows = list(rows)
+        return self
+
+    def fetched(self, rows):
+        self.connection.count("rows", len(rows))
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if len(rows) > 0 else None
+
+    def fetchmany(self, size = 1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return self.fetched(rows)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return self.fetched(rows)
 
-    # parse args
+    def fetch_pandas_batches(self):
+        raise snowflake.connector.errors.NotSupportedError("Not available for recorded statements")
+
+    def close(self):
+        pass
+
+class RecordingCursor(FixtureCursor):
+    def __init__(self, connection, cursor):
+        super().__init__(connection)
+        self.cursor = cursor
+
+    def execute(self, sql, params = None, **options):
+        self.connection.count("statements")
+        try:
+            self.cursor.execute(sql, params, **options)
+            names = [col[0] for col in self.cursor.description] if self.cursor.description != None else None
+            rows = self.cursor.fetchall()
+        except snowflake.connector.errors.Error as e:
+            self.connection.record(sql, params, error=(type(e).__name__, str(e)))
+            raise
+        self.connection.record(sql, params, names, rows)
+        return self.serve(names, rows)
+
+    def close(self):
+        self.cursor.close()
+
+class ReplayCursor(FixtureCursor):
+    def execute(self, sql, params = None, **options):
+        self.connection.count("statements")
+        statement = self.connection.find(sql, params)
+        if self.connection.latency > 0:
+            time.sleep(self.connection.latency)
+        if statement == None:
+            raise snowflake.connector.errors.ProgrammingError(f"Statement not recorded: {sql[:80]}")
+        if statement.get("error") != None:
+            name, message = statement["error"]
+            raise getattr(snowflake.connector.errors, name, snowflake.connector.errors.ProgrammingError)(message)
+        return self.serve(statement["description"],
+            [tuple(fromFixtureValue(value) for value in row) for row in statement["rows"]])
+
+class FixtureConnection:
+    """
+    Records all statements of a real connection into a fixture file (when con is given),
+    or replays them from the fixture, with an injected latency (in ms) per statement
+    """
+    def __init__(self, fixtureFile, con = None, config = None, latency = 0):
+        self.fixtureFile = fixtureFile
+        self.con = con
+        self.latency = latency / 1000.0
+        self.lock = threading.Lock()
+        self.stats = { "statements": 0, "rows": 0 }
+        if con != None:
+            self.fixture = { "config": { name: config[name] for name in ["account", "role"] }, "statements": [] }
+        else:
+            with open(fixtureFile) as f:
+                self.fixture = json.load(f)
+        self.replayed = {}
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.stats[name] += n
+
+    def record(self, sql, params, names = None, rows = (), error = None):
+        with self.lock:
+            self.fixture["statements"].append({ "sql": sql,
+                "params": [toFixtureValue(value) for value in params] if params != None else None,
+                "description": names,
+                "rows": [[toFixtureValue(value) for value in row] for row in rows],
+                "error": error })
+
+    def find(self, sql, params):
+        """
+        The next recorded response of a statement, with the same parameters when possible
+        (time-dependent parameters differ between runs), and the last one once all are replayed
+        """
+        params = [toFixtureValue(value) for value in params] if params != None else None
+        with self.lock:
+            for exact in (True, False):
+                matches = [i for i, statement in enumerate(self.fixture["statements"])
+                    if statement["sql"] == sql and (not exact or statement["params"] == params)]
+                if len(matches) > 0:
+                    key = (sql, json.dumps(params, default=str) if exact else None)
+                    n = self.replayed.get(key, 0)
+                    self.replayed[key] = n + 1
+                    return self.fixture["statements"][matches[min(n, len(matches) - 1)]]
+        return None
+
+    def cursor(self):
+        return RecordingCursor(self, self.con.cursor()) if self.con != None else ReplayCursor(self)
+
+    def close(self):
+        if self.con != None:
+            self.con.close()
+            with open(self.fixtureFile, "w") as f:
+                json.dump(self.fixture, f, default=str)
+
+def showRunStats(stats, wallTimes):
+    """
+    Statements issued, rows fetched, wall time and peak memory of recorded or replayed runs, on stderr
+    """
+    try:
+        import resource
+        memory = f", peak memory {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.0f} MB"
+    except ImportError:
+        memory = ""
+    runs = len(wallTimes)
+    times = sorted(wallTimes)
+    print(f"{stats['statements'] // runs:,} statements issued, {stats['rows'] // runs:,} rows fetched, "
+        + (f"in {times[0]:.3f} s" if runs == 1
+            else f"in {times[0]:.3f} s min, {times[runs // 2]:.3f} s median, over {runs} runs")
+        + memory + ".", file=sys.stderr)
+
+def getTraceLabel(sql):
+    for pattern, label in TRACE_LABELS:
+        if pattern.search(sql.strip()):
+            return label
+    return "query run"
+
+class TracingCursor:
+    """
+    Cursor timing each statement, with its label, Snowflake query ID, and the rows
+    and (approximate, as text) bytes fetched
+    """
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+        self.event = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def execute(self, sql, params = None, **options):
+        self.event = { "label": getTraceLabel(sql), "sql": sql, "thread": threading.get_ident(),
+            "start": time.perf_counter(), "queryId": None, "rows": 0, "bytes": 0, "fetchTime": 0.0, "error": None }
+        self.connection.add(self.event)
+        try:
+            self.cursor.execute(sql, params, **options)
+        except Exception as e:
+            self.event["error"] = str(e)
+            raise
+        finally:
+            self.event["elapsed"] = time.perf_counter() - self.event["start"]
+            self.event["queryId"] = getattr(self.cursor, "sfqid", None)
+        return self
+
+    def fetched(self, rows, start):
+        if self.event != None:
+            self.event["fetchTime"] += time.perf_counter() - start
+            self.event["rows"] += len(rows)
+            self.event["bytes"] += sum(len(str(value)) for row in rows for value in row if value != None)
+        return rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.fetched([row] if row != None else [], start)
+        return row
+
+    def fetchmany(self, size = 1):
+        start = time.perf_counter()
+        return self.fetched(self.cursor.fetchmany(size), start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        return self.fetched(self.cursor.fetchall(), start)
+
+    def fetch_pandas_batches(self):
+        start = time.perf_counter()
+        for frame in self.cursor.fetch_pandas_batches():
+            self.event["fetchTime"] += time.perf_counter() - start
+            self.event["rows"] += len(frame)
+            self.event["bytes"] += int(frame.memory_usage(deep=True).sum())
+            yield frame
+            start = time.perf_counter()
+
+class TracingConnection:
+    """
+    Connection tracing the statements of all its cursors, including the cursors opened from them
+    """
+    def __init__(self, con):
+        self.con = con
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def cursor(self):
+        return TracingCursor(self, self.con.cursor())
+
+    def close(self):
+        self.con.close()
+
+def showTrace(events):
+    """
+    Summary table of the traced statements, by label, on stderr
+    """
+    labels = {}
+    for event in events:
+        label = labels.setdefault(event["label"], { "count": 0, "elapsed": 0.0, "max": 0.0, "fetch": 0.0, "rows": 0, "bytes": 0 })
+        label["count"] += 1
+        label["elapsed"] += event.get("elapsed", 0.0)
+        label["max"] = max(label["max"], event.get("elapsed", 0.0))
+        label["fetch"] += event["fetchTime"]
+        label["rows"] += event["rows"]
+        label["bytes"] += event["bytes"]
+
+    print(f"\n{len(events):,} statements issued by the profiler (round trips):", file=sys.stderr)
+    print(f"  {'statement':<30}{'count':>7}{'total s':>10}{'max s':>10}{'fetch s':>10}{'rows':>12}  bytes", file=sys.stderr)
+    for name, label in sorted(labels.items(), key=lambda item: item[1]["elapsed"], reverse=True):
+        print(f"  {name:<30}{label['count']:>7,}{label['elapsed']:>10.3f}{label['max']:>10.3f}{label['fetch']:>10.3f}"
+            f"{label['rows']:>12,}  {sizeof_fmt(label['bytes'])}", file=sys.stderr)
+
+def saveTrace(events, start, traceFile):
+    """
+    Save the traced statements as a Chrome trace (chrome://tracing, or https://ui.perfetto.dev),
+    one lane per thread, with the query ID, rows and bytes fetched of each statement
+    """
+    threads = {}
+    traceEvents = []
+    for event in events:
+        tid = threads.setdefault(event["thread"], len(threads))
+        traceEvents.append({ "name": event["label"], "cat": "statement", "ph": "X", "pid": os.getpid(), "tid": tid,
+            "ts": round((event["start"] - start) * 1000000), "dur": round(event.get("elapsed", 0.0) * 1000000),
+            "args": { "queryId": event["queryId"], "rows": event["rows"], "bytes": event["bytes"],
+                "fetchTime": event["fetchTime"], "error": event["error"], "sql": event["sql"][:1000] } })
+    with open(traceFile, "w") as f:
+        json.dump({ "traceEvents": traceEvents, "displayTimeUnit": "ms" }, f, indent=1)
+
+def newAggregate():
+    return { "count": 0, "elapsed": 0, "bytesScanned": 0, "spilledLocal": 0, "spilledRemote": 0,
+        "cacheRatio": 0.0, "partitionsScanned": 0, "partitionsTotal": 0, "sketch": {} }
+
+def sketchBucket(value):
+    # log-scaled bucket, so that all values of a bucket are within SKETCH_GAMMA of each other
+    return 0 if value <= 1 else math.ceil(math.log(value) / math.log(SKETCH_GAMMA))
+
+def sketchQuantile(sketch, q):
+    """
+    Approximate quantile of the values added to a sketch of bucket counts
+    """
+    total = sum(sketch.values())
+    rank = q * (total - 1)
+    seen = 0
+    for bucket in sorted(sketch):
+        seen += sketch[bucket]
+        if seen > rank:
+            return 0 if bucket == 0 else 2 * SKETCH_GAMMA ** bucket / (SKETCH_GAMMA + 1)
+    return None
+
+def addWorkloadFrame(aggregates, frame):
+    """
+    Add a pandas DataFrame batch of QUERY_HISTORY rows to the per-fingerprint aggregates
+    """
+    import numpy as np
+
+    frame = frame.fillna(0)
+    elapsed = frame["TOTAL_ELAPSED_TIME"].astype("float64").to_numpy()
+    frame = frame.assign(BUCKET=np.where(elapsed <= 1, 0,
+        np.ceil(np.log(np.maximum(elapsed, 1)) / math.log(SKETCH_GAMMA))).astype("int64"))
+    sums = frame.groupby("QUERY_KEY").agg(
+        count=("TOTAL_ELAPSED_TIME", "size"),
+        elapsed=("TOTAL_ELAPSED_TIME", "sum"),
+        bytesScanned=("BYTES_SCANNED", "sum"),
+        spilledLocal=("BYTES_SPILLED_TO_LOCAL_STORAGE", "sum"),
+        spilledRemote=("BYTES_SPILLED_TO_REMOTE_STORAGE", "sum"),
+        cacheRatio=("PERCENTAGE_SCANNED_FROM_CACHE", "sum"),
+        partitionsScanned=("PARTITIONS_SCANNED", "sum"),
+        partitionsTotal=("PARTITIONS_TOTAL", "sum"))
+    for key, row in zip(sums.index, sums.itertuples(index=False)):
+        aggregate = aggregates.setdefault(key, newAggregate())
+        for name, value in row._asdict().items():
+            aggregate[name] += value
+    for (key, bucket), count in frame.groupby(["QUERY_KEY", "BUCKET"]).size().items():
+        sketch = aggregates[key]["sketch"]
+        sketch[int(bucket)] = sketch.get(int(bucket), 0) + int(count)
+
+def addWorkloadRows(aggregates, rows):
+    """
+    Same as addWorkloadFrame, one row at a time, when pandas is not available
+    """
+    for key, elapsed, bytesScanned, spilledLocal, spilledRemote, cacheRatio, partitionsScanned, partitionsTotal in rows:
+        aggregate = aggregates.setdefault(key, newAggregate())
+        aggregate["count"] += 1
+        aggregate["elapsed"] += elapsed or 0
+        aggregate["bytesScanned"] += bytesScanned or 0
+        aggregate["spilledLocal"] += spilledLocal or 0
+        aggregate["spilledRemote"] += spilledRemote or 0
+        aggregate["cacheRatio"] += float(cacheRatio or 0)
+        aggregate["partitionsScanned"] += partitionsScanned or 0
+        aggregate["partitionsTotal"] += partitionsTotal or 0
+        bucket = sketchBucket(elapsed or 0)
+        aggregate["sketch"][bucket] = aggregate["sketch"].get(bucket, 0) + 1
+
+def pruneAggregates(aggregates, maxFingerprints = WORKLOAD_MAX_FINGERPRINTS):
+    # keep memory bounded: forget the fingerprints with the least total time
+    if len(aggregates) > maxFingerprints:
+        kept = sorted(aggregates, key=lambda key: aggregates[key]["elapsed"], reverse=True)[:maxFingerprints // 2]
+        kept = { key: aggregates[key] for key in kept }
+        aggregates.clear()
+        aggregates.update(kept)
+
+def getWorkloadFlags(aggregates, keys):
+    """
+    Labels of the rules fired by the averages of each fingerprint, evaluated column-wise
+    """
+    rows = [{
+        "BYTES_SPILLED_TO_LOCAL_STORAGE": aggregates[key]["spilledLocal"] / aggregates[key]["count"],
+        "BYTES_SPILLED_TO_REMOTE_STORAGE": aggregates[key]["spilledRemote"] / aggregates[key]["count"],
+        "BYTES_SCANNED": aggregates[key]["bytesScanned"] / aggregates[key]["count"],
+        "PERCENTAGE_SCANNED_FROM_CACHE": aggregates[key]["cacheRatio"] / aggregates[key]["count"],
+        "PARTITIONS_SCANNED": aggregates[key]["partitionsScanned"],
+        "PARTITIONS_TOTAL": aggregates[key]["partitionsTotal"] } for key in keys]
+    try:
+        import numpy as np
+    except ImportError:
+        return [getRuleLabels(evaluateRules(row)) for row in rows]
+
+    fired = evaluateRules({ name: np.array([row[name] for row in rows], dtype="float64") for name in rows[0] })
+    return [getRuleLabels({ name: mask[i] for name, mask in fired.items() }) for i in range(len(keys))]
+
+def getWorkload(days, cur):
+    """
+    Stream all queries of the last days from ACCOUNT_USAGE.QUERY_HISTORY, in batches,
+    into aggregates per fingerprint, in bounded memory
+    """
+    cur.execute(
+        f"select {QUERY_KEY_SQL} as QUERY_KEY, TOTAL_ELAPSED_TIME, BYTES_SCANNED, "
+        "BYTES_SPILLED_TO_LOCAL_STORAGE, BYTES_SPILLED_TO_REMOTE_STORAGE, "
+        "PERCENTAGE_SCANNED_FROM_CACHE, PARTITIONS_SCANNED, PARTITIONS_TOTAL "
+        "from SNOWFLAKE.ACCOUNT_USAGE.QUERY_HISTORY "
+        "where START_TIME > DATEADD(day, -?, CURRENT_TIMESTAMP()) "
+        "and TOTAL_ELAPSED_TIME > 0 "
+        f"and {NOT_PROFILER_SQL}",
+        (days,))
+
+    aggregates = {}
+    try:
+        for frame in cur.fetch_pandas_batches():
+            addWorkloadFrame(aggregates, frame)
+            pruneAggregates(aggregates)
+    except (ImportError, AttributeError, snowflake.connector.errors.NotSupportedError,
+            snowflake.connector.errors.ProgrammingError) as e:
+        # without pandas, nothing has been fetched yet, but any other error is raised again
+        if isinstance(e, snowflake.connector.errors.ProgrammingError) and getattr(e, "errno", None) != NO_PANDAS_ERRNO:
+            raise
+        while True:
+            rows = cur.fetchmany(WORKLOAD_BATCH_ROWS)
+            if len(rows) == 0:
+                break
+            addWorkloadRows(aggregates, rows)
+            pruneAggregates(aggregates)
+    return aggregates
+
+def showWorkload(days, cur, n = WORKLOAD_TOP):
+    """
+    Show the queries to fix first, by total elapsed time, over the whole workload of the last days
+    """
+    aggregates = getWorkload(days, cur)
+    top = sorted(aggregates, key=lambda key: aggregates[key]["elapsed"], reverse=True)[:n]
+    print(f"{sum(a['count'] for a in aggregates.values()):,} queries, "
+        f"{len(aggregates):,} distinct queries in the last {days} days.")
+    if len(top) == 0:
+        return
+
+    # one sample query text for each top fingerprint
+    cur.execute(
+        f"select {QUERY_KEY_SQL} as QUERY_KEY, QUERY_TEXT "
+        "from SNOWFLAKE.ACCOUNT_USAGE.QUERY_HISTORY "
+        "where START_TIME > DATEADD(day, -?, CURRENT_TIMESTAMP()) "
+        f"and QUERY_KEY in ({', '.join(['?'] * len(top))}) "
+        "qualify row_number() over (partition by QUERY_KEY order by START_TIME desc) = 1",
+        (days, *top))
+    texts = dict(cur.fetchall())
+
+    flags = getWorkloadFlags(aggregates, top)
+    print(f"\nThe top {len(top)} queries to fix first, by total elapsed time:")
+    for rank, key in enumerate(top, start=1):
+        aggregate = aggregates[key]
+        count = aggregate["count"]
+        text = " ".join((texts.get(key) or "").split())
+        print(f"\n#{rank} {key}: {text[:100]}" + ("..." if len(text) > 100 else ""))
+        print(f"  {count:,} runs, {aggregate['elapsed'] / 1000:,.1f} seconds in total, "
+            f"p50 {sketchQuantile(aggregate['sketch'], 0.5):,.0f} ms, p95 {sketchQuantile(aggregate['sketch'], 0.95):,.0f} ms")
+        print(f"  {sizeof_fmt(aggregate['bytesScanned'])} scanned, "
+            f"{sizeof_fmt(aggregate['spilledLocal'])} spilled to local storage, "
+            f"{sizeof_fmt(aggregate['spilledRemote'])} spilled to remote storage, "
+            f"{aggregate['cacheRatio'] / count:.0%} from cache")
+        if len(flags[rank - 1]) > 0:
+            print(f"  Hint: look at the {', '.join(flags[rank - 1])}.")
+
+# openers of a literal, quoted identifier or comment left open, as tokenized
+UNTERMINATED_TOKENS = ("'", '"', "$$", "/*")
+
+def endsStatement(sqlText):
+    """
+    Whether a SQL text ends with a top-level ';', not one in a literal, quoted identifier or comment (even left open)
+    """
+    last = None
+    for match in QUERY_TOKEN_PATTERN.finditer(sqlText):
+        kind = match.lastgroup
+        if kind == "other" and sqlText.startswith(UNTERMINATED_TOKENS, match.start()):
+            return False
+        if kind != "space" and kind != "comment":
+            last = match.group()
+    return last == ";"
+
+def readBatch(f):
+    """
+    Read query IDs (one per line) and SQL texts (each ending with a top-level ';' on a line) from a batch file
+    """
+    entries = []
+    lines = []
+    for line in f:
+        if len(lines) == 0 and QUERY_ID_PATTERN.match(line.strip()):
+            entries.append(("ID", line.strip()))
+        elif len(lines) > 0 or line.strip() != "":
+            lines.append(line)
+            if line.rstrip().endswith(";") and endsStatement("".join(lines)):
+                entries.append(("SQL", "".join(lines).strip()))
+                lines = []
+    if "".join(lines).strip() != "":
+        entries.append(("SQL", "".join(lines).strip()))
+    return entries
+
+def getLookupWindows(source, around = None, now = None):
+    """
+    Successive disjoint START_TIME windows of a lookup, each as a list of (start, end) ranges,
+    widened exponentially around a hint (or back from now), up to the retention of the schema
+    """
+    firstHours, retentionDays = LOOKUP_WINDOWS[source]
+    now = now or datetime.now(timezone.utc)
+    oldest = now - timedelta(days=retentionDays)
+    center = min(around or now, now)
+    windows = []
+    previous = timedelta(0)
+    width = timedelta(hours=firstHours)
+    while True:
+        ranges = [(max(start, oldest), min(end, now))
+            for start, end in [(center - width, center - previous), (center + previous, center + width)]]
+        ranges = [(start, end) for start, end in ranges if start < end]
+        if len(ranges) > 0:
+            windows.append(ranges)
+        if center - width <= oldest and center + width >= now:
+            return windows
+        previous, width = width, width * LOOKUP_WINDOW_GROWTH
+
+def getHistoryRows(source, column, values, cur, ranges = None):
+    """
+    Fetch in bulk the most recent QUERY_HISTORY row for each value of a column (QUERY_ID or QUERY_TEXT),
+    from ACCOUNT_USAGE or INFORMATION_SCHEMA, with only the columns of the report, within the START_TIME ranges
+    """
+    found = {}
+    values = list(dict.fromkeys(values))
+    ranges = ranges or []
+    if source == "ACCOUNT_USAGE":
+        columns = HISTORY_COLUMNS + ACCOUNT_USAGE_COLUMNS
+        table = "snowflake.account_usage.query_history"
+        tableParams = ()
+    elif len(ranges) > 0:
+        columns = HISTORY_COLUMNS
+        table = ("table(information_schema.query_history("
+            f"end_time_range_start => {UTC_TIME_SQL}, end_time_range_end => {UTC_TIME_SQL}, "
+            f"result_limit => {INFORMATION_SCHEMA_RESULT_LIMIT}))")
+        tableParams = (toMirrorTime(min(start for start, end in ranges)),
+            toMirrorTime(max(end for start, end in ranges) + timedelta(hours=INFORMATION_SCHEMA_END_SLACK_HOURS)))
+    else:
+        columns = HISTORY_COLUMNS
+        table = f"table(information_schema.query_history(result_limit => {INFORMATION_SCHEMA_RESULT_LIMIT}))"
+        tableParams = ()
+    timeFilter = " or ".join([f"(START_TIME >= {UTC_TIME_SQL} and START_TIME < {UTC_TIME_SQL})"] * len(ranges))
+    timeParams = tuple(toMirrorTime(time) for window in ranges for time in window)
+
+    for i in range(0, len(values), BATCH_SIZE):
+        chunk = values[i:i + BATCH_SIZE]
+        cur.execute(
+            f"select {', '.join(columns)} "
+            f"from {table} "
+            f"where {column} in ({', '.join(['?'] * len(chunk))}) "
+            + (f"and ({timeFilter}) " if len(ranges) > 0 else "")
+            + f"qualify row_number() over (partition by {column} order by start_time desc) = 1",
+            tableParams + tuple(chunk) + timeParams)
+        names = [col[0] for col in cur.description]
+        for row in cur.fetchall():
+            props = dict(zip(names, row))
+            found[props[column]] = props
+    return found
+
+def lookupHistoryRows(source, column, values, cur, hints = None, around = None):
+    """
+    Look up QUERY_HISTORY rows in narrow START_TIME windows, widened only for the values still missing.
+    Values are grouped by the day of their hint (from the mirror), or the user hint, or none (back from now)
+    """
+    found = {}
+    groups = {}
+    for value in dict.fromkeys(values):
+        hint = (hints or {}).get(value, around)
+        if hint != None:
+            hint = hint.replace(hour=12, minute=0, second=0, microsecond=0)
+        groups.setdefault(hint, []).append(value)
+
+    for hint, group in groups.items():
+        for ranges in getLookupWindows(source, hint):
+            missing = [value for value in group if value not in found]
+            if len(missing) == 0:
+                break
+            found.update(getHistoryRows(source, column, missing, cur, ranges))
+    return found
+
+def findQueries(entries, cur, db = None, around = None):
+    """
+    Look up all queries (by ID or SQL) in ACCOUNT_USAGE, then the missing ones in INFORMATION_SCHEMA,
+    as a set, around their START_TIME when known. Returns a (props, isAccountUsage) pair for each entry,
+    with props None when not found
+    """
+    # with a local mirror, SQL texts are matched by fingerprint, then looked up by ID
+    mirrorIds = (findMirrorQueryIds([value for kind, value in entries if kind == "SQL"], db)
+        if db != None else {})
+    lookups = [("ID", mirrorIds[value]) if kind == "SQL" and value in mirrorIds else (kind, value)
+        for kind, value in entries]
+
+    columns = { "ID": "QUERY_ID", "SQL": "QUERY_TEXT" }
+    results = {}
+    for kind, column in columns.items():
+        values = [value for k, value in lookups if k == kind]
+        if len(values) == 0:
+            continue
+        hints = getMirrorStartTimes(values, db) if db != None and kind == "ID" else {}
+        found = lookupHistoryRows("ACCOUNT_USAGE", column, values, cur, hints, around)
+        missing = [value for value in values if value not in found]
+        foundIS = (lookupHistoryRows("INFORMATION_SCHEMA", column, missing, cur, hints, around)
+            if len(missing) > 0 else {})
+        for value in values:
+            results[(kind, value)] = ((found[value], True) if value in found
+                else (foundIS[value], False) if value in foundIS
+                else (None, False))
+    return [results[lookup] for lookup in lookups]
+
+def runQuery(queryText, cur, mode = "run", timeout = RUN_TIMEOUT_SECONDS, rowLimit = RUN_ROW_LIMIT):
+    """
+    Execute the SQL query, and get its QUERY_HISTORY row from INFORMATION_SCHEMA. With the cache mode,
+    only for a few seconds (the result cache is not checked first: any query done by then runs in full),
+    and with the limit mode, with a cap on its rows. Returns its row (or None), and whether it has been cancelled,
+    after the timeout
+    """
+    if mode == "limit":
+        # on its own line, the closing parenthesis cannot be commented out by a trailing -- comment
+        queryText = f"select * from ({queryText.strip().rstrip(';')}\n) limit {rowLimit}"
+    try:
+        cur.execute(queryText, timeout=min(timeout, CACHE_CHECK_SECONDS) if mode == "cache" else timeout)
+    except snowflake.connector.errors.ProgrammingError as e:
+        if getattr(e, "errno", None) == QUERY_CANCELLED_ERRNO:
+            return None, True
+        raise
+    cur.execute("select last_query_id()")
+    queryId = cur.fetchone()[0]
+    return lookupHistoryRows("INFORMATION_SCHEMA", "QUERY_ID", [queryId], cur).get(queryId), False
+
+def newPlanNode(step, id, operation, objects = None, expressions = None, stats = None):
+    node = { "step": step, "id": id, "operation": operation,
+        "objects": objects or [], "expressions": expressions or [], "children": [] }
+    for name in PLAN_STATS:
+        node[name] = (stats or {}).get(name)
+    return node
+
+def parseJsonPlan(explain):
+    """
+    Parse the output of EXPLAIN USING JSON into a plan, with a tree of operators
+    """
+    doc = json.loads(explain)
+    stats = doc.get("GlobalStats", {})
+    plan = { name: stats.get(name) for name in PLAN_STATS }
+    plan["operations"] = []
+    plan["roots"] = []
+    for step, operations in enumerate(doc.get("Operations", []), start=1):
+        nodes = {}
+        for op in operations:
+            nodes[op["id"]] = newPlanNode(step, op["id"], op.get("operation"),
+                op.get("objects"), op.get("expressions"), op)
+            plan["operations"].append(nodes[op["id"]])
+        for op in operations:
+            parents = op.get("parentOperators") or []
+            if len(parents) == 0:
+                plan["roots"].append(nodes[op["id"]])
+            for parent in parents:
+                if parent in nodes:
+                    nodes[parent]["children"].append(nodes[op["id"]])
+    return plan
+
+def parseTextPlan(explain):
+    """
+    Parse the output of EXPLAIN USING TEXT into the same plan as parseJsonPlan
+    """
+    plan = { name: None for name in PLAN_STATS }
+    plan["operations"] = []
+    plan["roots"] = []
+    stack = []
+    for line in explain.splitlines():
+        match = PLAN_STAT_PATTERN.match(line)
+        if match and match.group(1) in PLAN_STATS and len(plan["operations"]) == 0:
+            plan[match.group(1)] = int(match.group(2))
+            continue
+        match = PLAN_LINE_PATTERN.match(line)
+        if match == None:
+            continue
+        depth = line.index("->")
+        parts = [part for part in match.group(4).split("  ") if part.strip() != ""]
+        stats = {}
+        if len(parts) > 0 and parts[-1].strip().startswith("{"):
+            stats = { k.strip(): int(v) for k, v in PLAN_STAT_PATTERN.findall(parts.pop().strip(" {}").replace(", ", "\n")) }
+        objects = [parts.pop(0).strip()] if match.group(3) in ("TableScan", "ExternalScan") and len(parts) > 0 else []
+        node = newPlanNode(int(match.group(1)), int(match.group(2)), match.group(3),
+            objects, [part.strip() for part in parts], stats)
+        plan["operations"].append(node)
+
+        # the parent is the closest operator above, with less indentation
+        while len(stack) > 0 and stack[-1][0] >= depth:
+            stack.pop()
+        if len(stack) == 0:
+            plan["roots"].append(node)
+        else:
+            stack[-1][1]["children"].append(node)
+        stack.append((depth, node))
+    return plan
+
+def formatPlan(plan):
+    """
+    Show the plan in the same tabular form as EXPLAIN USING TEXT
+    """
+    if plan == None:
+        return "The query cannot be explained (a CALL, COPY, or DDL statement, or on objects not visible to this role)."
+    lines = ["GlobalStats:"]
+    for name in PLAN_STATS:
+        lines.append(f"    {name}={plan[name]}")
+    lines.append("Operations:")
+
+    def formatNode(node, depth):
+        stats = ", ".join(f"{name}={node[name]}" for name in PLAN_STATS if node[name] != None)
+        parts = [node["operation"]] + node["objects"] + [", ".join(node["expressions"])] + ([f"{{{stats}}}"] if stats != "" else [])
+        lines.append(f"{node['step']}:{node['id']}".ljust(8) + " " * (5 * depth) + "->" + "  ".join(p for p in parts if p != ""))
+        for child in node["children"]:
+            formatNode(child, depth + 1)
+
+    for root in plan["roots"]:
+        formatNode(root, 0)
+    return "\n".join(lines)
+
+def getTableScans(plan):
+    return [node for node in plan["operations"] if node["operation"] == "TableScan"]
+
+def getPlanCacheFile(account, role, queryText):
+    key = hashlib.sha1(f"{account}|{role}|{queryText}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"plan-{key}.json")
+
+def explainQuery(queryText, con, cacheFile = None, ttlMinutes = CACHE_TTL_MINUTES):
+    """
+    Get the EXPLAIN plan of a query, on its own cursor, so that it can run concurrently.
+    The JSON plan is parsed into a tree of operators, with a fallback to the text plan,
+    or None when the query cannot be explained (a CALL, COPY, or DDL statement, a compilation error,
+    or objects not visible to this role)
+    """
+    plan = loadCache(cacheFile, ttlMinutes) if cacheFile != None else None
+    if plan != None:
+        return plan
+
+    cur = con.cursor()
+    try:
+        try:
+            cur.execute(f"explain using json {queryText}")
+            plan = parseJsonPlan(cur.fetchone()[0])
+        except (snowflake.connector.errors.ProgrammingError, ValueError, KeyError, TypeError):
+            cur.execute(f"explain using text {queryText}")
+            plan = parseTextPlan(cur.fetchone()[0])
+    except snowflake.connector.errors.ProgrammingError:
+        return None
+    finally:
+        cur.close()
+
+    if cacheFile != None:
+        saveCache(cacheFile, plan)
+    return plan
+
+def parseVariant(value, default):
+    # VARIANT and ARRAY columns are returned as JSON text
+    if value == None:
+        return default
+    return json.loads(value) if isinstance(value, str) else value
+
+def buildOperatorTree(rows):
+    """
+    Build the DAG of operators from the rows of GET_QUERY_OPERATOR_STATS, with their share
+    of the execution time, rows in/out, and flags for spilling, poor pruning and exploding joins
+    """
+    tree = { "operators": [], "roots": [] }
+    nodes = {}
+    for step, id, parents, type, stats, breakdown, attributes in rows:
+        stats = parseVariant(stats, {})
+        spilling = stats.get("spilling", {})
+        pruning = stats.get("pruning", {})
+        node = {
+            "step": step, "id": id, "type": type,
+            "parents": parseVariant(parents, []),
+            "children": [],
+            "attributes": parseVariant(attributes, {}),
+            "share": float(parseVariant(breakdown, {}).get("overall_percentage", 0)),
+            "inputRows": stats.get("input_rows"),
+            "outputRows": stats.get("output_rows"),
+            "bytesSpilledLocal": spilling.get("bytes_spilled_local_storage", 0),
+            "bytesSpilledRemote": spilling.get("bytes_spilled_remote_storage", 0),
+            "partitionsScanned": pruning.get("partitions_scanned"),
+            "partitionsTotal": pruning.get("partitions_total") }
+        node["spilling"] = node["bytesSpilledLocal"] + node["bytesSpilledRemote"] >= THRESHOLDS["SPILL_BYTES"]
+        node["poorPruning"] = (bool(node["partitionsTotal"]) and node["partitionsScanned"] != None
+            and node["partitionsScanned"] > THRESHOLDS["PRUNING_RATIO"] * node["partitionsTotal"])
+        node["explodingJoin"] = (type.endswith("Join") and bool(node["inputRows"])
+            and node["outputRows"] != None and node["outputRows"] > THRESHOLDS["JOIN_EXPLOSION_FACTOR"] * node["inputRows"])
+        nodes[(step, id)] = node
+        tree["operators"].append(node)
+
+    for node in tree["operators"]:
+        parents = [nodes[(node["step"], parent)] for parent in node["parents"] if (node["step"], parent) in nodes]
+        if len(parents) == 0:
+            tree["roots"].append(node)
+        for parent in parents:
+            parent["children"].append(node)
+    return tree
+
+def getOperatorStats(queryId, con):
+    """
+    Get the statistics of each operator of an executed query, on its own cursor,
+    or None when not available (for queries older than 14 days, or run by other users)
+    """
+    cur = con.cursor()
+    try:
+        cur.execute(
+            "select STEP_ID, OPERATOR_ID, PARENT_OPERATORS, OPERATOR_TYPE, "
+            "OPERATOR_STATISTICS, EXECUTION_TIME_BREAKDOWN, OPERATOR_ATTRIBUTES "
+            "from table(get_query_operator_stats(?)) "
+            "order by STEP_ID, OPERATOR_ID",
+            (queryId,))
+        return buildOperatorTree(cur.fetchall())
+    except snowflake.connector.errors.ProgrammingError:
+        return None
+    finally:
+        cur.close()
+
+def formatOperator(node):
+    table = node['attributes'].get('table_name')
+    return f"[{node['step']}:{node['id']}] {node['type']}" + (f" on {table}" if table else "")
+
+def showFlaggedOperators(operators, flag, message):
+    if operators == None:
+        return
+    flagged = [node for node in operators['operators'] if node[flag]]
+    if len(flagged) == 0:
+        return
+    print(message)
+    for node in flagged:
+        if flag == "poorPruning":
+            details = f"{node['partitionsScanned']:,} partitions out of a total of {node['partitionsTotal']:,} scanned"
+        elif flag == "explodingJoin":
+            details = f"{node['inputRows']:,} rows in, {node['outputRows']:,} rows out"
+        else:
+            details = f"{sizeof_fmt(node[flag])} spilled"
+        print(f"  {formatOperator(node)}: {details}, {node['share']:.0%} of the execution time")
+
+def showOperators(operators, n = TOP_OPERATORS):
+    print(f"\nThe top {n} operators by execution time:")
+    for node in sorted(operators['operators'], key=lambda node: node['share'], reverse=True)[:n]:
+        rows = (f", {node['inputRows']:,} rows in" if node['inputRows'] != None else "") + (
+            f", {node['outputRows']:,} rows out" if node['outputRows'] != None else "")
+        flags = [label for flag, label in OPERATOR_FLAGS.items() if node[flag]]
+        print(f"  {formatOperator(node)}: {node['share']:.0%}{rows}"
+            + (f" ({', '.join(flags)})" if len(flags) > 0 else ""))
+
+def mergeWindows(intervals, gap = timedelta(minutes=CONTENTION_MERGE_MINUTES)):
+    # (start, end) intervals merged when overlapping or closer than the gap
+    windows = []
+    for start, end in sorted(intervals):
+        if len(windows) > 0 and start - windows[-1][1] < gap:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+def getWarehouseQueries(source, warehouse, start, end, cur):
+    """
+    Fetch the queries on a warehouse running between start and end, from ACCOUNT_USAGE or INFORMATION_SCHEMA
+    """
+    lookback = start - timedelta(hours=CONTENTION_LOOKBACK_HOURS)
+    if source == "ACCOUNT_USAGE":
+        table = "snowflake.account_usage.query_history"
+        where = f"WAREHOUSE_NAME = ? and START_TIME >= {UTC_TIME_SQL} and "
+        params = (warehouse, toMirrorTime(lookback))
+    else:
+        table = ("table(information_schema.query_history_by_warehouse(warehouse_name => ?, "
+            f"end_time_range_start => {UTC_TIME_SQL}, end_time_range_end => {UTC_TIME_SQL}, "
+            f"result_limit => {INFORMATION_SCHEMA_RESULT_LIMIT}))")
+        where = ""
+        params = (warehouse, toMirrorTime(start), toMirrorTime(end + timedelta(hours=INFORMATION_SCHEMA_END_SLACK_HOURS)))
+    cur.execute(
+        "select QUERY_ID, USER_NAME, START_TIME, END_TIME, EXECUTION_TIME, BYTES_SCANNED "
+        f"from {table} "
+        f"where {where}START_TIME < {UTC_TIME_SQL} and END_TIME > {UTC_TIME_SQL} "
+        f"and {NOT_PROFILER_SQL}",
+        params + (toMirrorTime(end), toMirrorTime(start)))
+    names = [col[0] for col in cur.description]
+    return [dict(zip(names, row)) for row in cur.fetchall()]
+
+def getWarehouseLoad(source, warehouse, start, end, cur):
+    """
+    Fetch the load history of a warehouse between start and end, from ACCOUNT_USAGE or INFORMATION_SCHEMA
+    """
+    if source == "ACCOUNT_USAGE":
+        table = "snowflake.account_usage.warehouse_load_history"
+        where = f"WAREHOUSE_NAME = ? and END_TIME > {UTC_TIME_SQL} and START_TIME < {UTC_TIME_SQL} "
+        params = (warehouse, toMirrorTime(start), toMirrorTime(end))
+    else:
+        table = ("table(information_schema.warehouse_load_history("
+            f"date_range_start => {UTC_TIME_SQL}, date_range_end => {UTC_TIME_SQL}, warehouse_name => ?))")
+        where = "1 = 1 "
+        params = (toMirrorTime(start), toMirrorTime(end), warehouse)
+    cur.execute(
+        "select START_TIME, END_TIME, AVG_RUNNING, AVG_QUEUED_LOAD, AVG_QUEUED_PROVISIONING, AVG_BLOCKED "
+        f"from {table} "
+        f"where {where}"
+        "order by START_TIME",
+        params)
+    names = [col[0] for col in cur.description]
+    return [dict(zip(names, row)) for row in cur.fetchall()]
+
+class ContentionIndex:
+    """
+    Queries and load history of the warehouses used in a batch, fetched once for all the queries profiled,
+    with the queries sorted by START_TIME, to find those overlapping any time window by bisection
+    """
+    def __init__(self):
+        self.queries = {}
+        self.starts = {}
+        self.maxDurations = {}
+        self.loads = {}
+
+    def load(self, found, cur):
+        # one fetch per warehouse (and schema) and merged window of the queries found
+        intervals = {}
+        for props, isAccountUsage in found:
+            if props != None and props['WAREHOUSE_NAME'] != None and props['END_TIME'] != None:
+                key = ("ACCOUNT_USAGE" if isAccountUsage else "INFORMATION_SCHEMA", props['WAREHOUSE_NAME'])
+                intervals.setdefault(key, []).append((props['START_TIME'], props['END_TIME']))
+
+        for key, windows in intervals.items():
+            source, warehouse = key
+            queries = {}
+            loads = []
+            for start, end in mergeWindows(windows):
+                for query in getWarehouseQueries(source, warehouse, start, end, cur):
+                    if query['END_TIME'] != None:
+                        queries[query['QUERY_ID']] = query
+                loads.extend(getWarehouseLoad(source, warehouse, start, end, cur))
+            self.queries[key] = sorted(queries.values(), key=lambda query: query['START_TIME'])
+            self.starts[key] = [query['START_TIME'] for query in self.queries[key]]
+            self.maxDurations[key] = max([query['END_TIME'] - query['START_TIME'] for query in self.queries[key]],
+                default=timedelta(0))
+            self.loads[key] = loads
+        return self
+
+    def overlapping(self, key, start, end):
+        # queries started before the end, and no earlier than the longest query before the start
+        queries = self.queries[key]
+        lo = bisect.bisect_left(self.starts[key], start - self.maxDurations[key])
+        hi = bisect.bisect_left(self.starts[key], end)
+        return [query for query in queries[lo:hi] if query['END_TIME'] > start]
+
+    def getContention(self, props, isAccountUsage, n = CONTENTION_TOP):
+        """
+        Contention of a query: its co-running queries, peak concurrency, top co-running queries
+        (by overlap, with their share of the data scanned during the query), and queue depth timeline
+        """
+        key = ("ACCOUNT_USAGE" if isAccountUsage else "INFORMATION_SCHEMA", props['WAREHOUSE_NAME'])
+        if key not in self.queries or props['END_TIME'] == None:
+            return None
+        start, end = props['START_TIME'], props['END_TIME']
+        queries = self.overlapping(key, start, end)
+
+        # sweep line over the query window: ends before starts, at the same time
+        events = sorted([(max(query['START_TIME'], start), 1) for query in queries]
+            + [(min(query['END_TIME'], end), -1) for query in queries])
+        running = peak = 0
+        peakTime = start
+        for at, delta in events:
+            running += delta
+            if running > peak:
+                peak, peakTime = running, at
+
+        # bytes scanned during the query window, prorated by overlap
+        coRunning = []
+        for query in queries:
+            overlap = (min(query['END_TIME'], end) - max(query['START_TIME'], start)).total_seconds()
+            duration = (query['END_TIME'] - query['START_TIME']).total_seconds()
+            bytesScanned = float(query['BYTES_SCANNED'] or 0) * (overlap / duration if duration > 0 else 1)
+            coRunning.append((query, overlap, bytesScanned))
+        totalBytes = sum(bytesScanned for query, overlap, bytesScanned in coRunning)
+        others = [item for item in coRunning if item[0]['QUERY_ID'] != props['QUERY_ID']]
+        top = sorted(others, key=lambda item: (item[1], item[2]), reverse=True)[:n]
+
+        return { "warehouse": props['WAREHOUSE_NAME'], "coRunning": len(others),
+            "peakConcurrency": max(peak, 1), "peakTime": peakTime,
+            "top": [{ "QUERY_ID": query['QUERY_ID'], "USER_NAME": query['USER_NAME'], "OVERLAP_SECONDS": overlap,
+                "BYTES_SHARE": bytesScanned / totalBytes if totalBytes > 0 else None }
+                for query, overlap, bytesScanned in top],
+            "timeline": [load for load in self.loads[key] if load['END_TIME'] > start and load['START_TIME'] < end] }
+
+def showContention(contention):
+    print(f"\nOn the {contention['warehouse']} warehouse, {contention['coRunning']:,} other queries ran at the same time, "
+        f"with up to {contention['peakConcurrency']:,} queries running (at {contention['peakTime']}).")
+    if len(contention['top']) > 0:
+        print("The query competed the most with:")
+        for query in contention['top']:
+            share = (f", {query['BYTES_SHARE']:.0%} of the data scanned meanwhile"
+                if query['BYTES_SHARE'] != None else "")
+            print(f"  {query['QUERY_ID']} by {query['USER_NAME']}: {query['OVERLAP_SECONDS']:,.1f} seconds together{share}")
+    if len(contention['timeline']) > 0:
+        print("Warehouse load (average queries running, queued on load, queued on provisioning, blocked):")
+        for load in contention['timeline']:
+            print(f"  {load['START_TIME']}: {float(load['AVG_RUNNING'] or 0):.2f} running, "
+                f"{float(load['AVG_QUEUED_LOAD'] or 0):.2f} queued, {float(load['AVG_QUEUED_PROVISIONING'] or 0):.2f} provisioning, "
+                f"{float(load['AVG_BLOCKED'] or 0):.2f} blocked")
+
+def buildProfile(kind, value, props, isAccountUsage, ranks, plan, operators, cur, baseline = None,
+        notFound = "explain", timeout = RUN_TIMEOUT_SECONDS, rowLimit = RUN_ROW_LIMIT, contention = None, credits = None,
+        explained = False):
+    """
+    Profile one query already looked up (by ID or SQL value), with its EXPLAIN plan, if already explained
+    (None when it cannot be).
+    A query not found by SQL is estimated from its EXPLAIN plan, or run, depending on the notFound mode.
+    Returns the profile: where it was found, raw metrics (and those estimated), ranks, baseline, contention,
+    cost (from the compute credits attributed in the mirror), fired hints, EXPLAIN plan and operators
+    """
+    profile = { "kind": kind, "value": value, "source": None, "isAccountUsage": isAccountUsage,
+        "metrics": None, "estimated": [], "notFound": None, "ranks": None, "baseline": None, "contention": None,
+        "cost": None, "watched": None, "hints": [], "plan": None, "operators": None }
+    if props != None:
+        profile["source"] = "ACCOUNT_USAGE" if isAccountUsage else "INFORMATION_SCHEMA"
+    elif kind == "ID":
+        return profile
+    else:
+        profile["notFound"] = { "mode": notFound, "timeout": timeout,
+            "rowLimit": rowLimit if notFound == "limit" else None, "cancelled": False }
+        if notFound == "explain":
+            return estimateProfile(profile, value, plan, cur)
+        props, profile["notFound"]["cancelled"] = runQuery(value, cur, notFound, timeout, rowLimit)
+        if profile["notFound"]["cancelled"]:
+            return estimateProfile(profile, value, plan, cur)
+        if props == None:
+            return profile
+        profile["source"] = "EXECUTED"
+        operators = getOperatorStats(props['QUERY_ID'], cur.connection)
+
+    # compared to its past runs (not for a capped run), before the metrics estimated from the EXPLAIN plan
+    if baseline != None and not (profile["notFound"] != None and profile["notFound"]["mode"] == "limit"):
+        profile["baseline"] = compareBaseline(baseline, props)
+
+    # EXPLAIN plan (of the query as passed, when not found), unless it could not be explained already
+    if plan == None and not explained:
+        plan = explainQuery(props['QUERY_TEXT'] if profile["source"] != "EXECUTED" else value, cur.connection)
+
+    # fill-in some properties from the explain plan
+    if plan != None and plan["partitionsTotal"] != None:
+        props["PARTITIONS_TOTAL"] = plan["partitionsTotal"]
+        props["PARTITIONS_SCANNED"] = plan["partitionsAssigned"]
+        props["BYTES_SCANNED"] = plan["bytesAssigned"]
+        profile["estimated"] = ["PARTITIONS_TOTAL", "PARTITIONS_SCANNED", "BYTES_SCANNED"]
+
+    if isAccountUsage and props['EXECUTION_STATUS'] == 'SUCCESS' and ranks == None:
+        ranks = getQueryRanks([queryKey(props)], cur)[queryKey(props)]
+
+    if credits != None:
+        profile["cost"] = { "credits": credits, "creditPrice": COSTS["CREDIT_PRICE"],
+            "dollars": credits * COSTS["CREDIT_PRICE"] }
+
+    profile.update(metrics=props, ranks=ranks, contention=contention, plan=plan, operators=operators,
+        hints=getHints(props, isAccountUsage, plan))
+    return profile
+
+def estimateProfile(profile, queryText, plan, cur):
+    """
+    Profile of a query that has not been run, with the only metrics estimated from its EXPLAIN plan
+    (none, when it cannot be explained)
+    """
+    if plan == None:
+        plan = explainQuery(queryText, cur.connection)
+    props = { "QUERY_TEXT": queryText }
+    if plan != None and plan["partitionsTotal"] != None:
+        props.update(PARTITIONS_TOTAL=plan["partitionsTotal"], PARTITIONS_SCANNED=plan["partitionsAssigned"],
+            BYTES_SCANNED=plan["bytesAssigned"])
+    profile.update(source="ESTIMATED", metrics=props, estimated=[name for name in props if name != "QUERY_TEXT"],
+        plan=plan, hints=[hint for hint in getHints(props, True, plan) if hint["section"] in ("scan", "pruning")])
+    return profile
+
+def showEstimate(profile):
+    print("=========================================================")
+    print(profile['metrics']['QUERY_TEXT'])
+    print("=========================================================")
+    if profile['plan'] == None:
+        print("The query has not been run, and could not be explained: nothing can be estimated.")
+        return
+    print("The query has not been run: all metrics below are estimated from its EXPLAIN plan, not measured.")
+    showHints("scan", profile['hints'])
+    showHints("pruning", profile['hints'])
+
+def showProfile(profile):
+    """
+    Text formatter of a profile, as the CLI always printed it
+    """
+    kind = profile['kind']
+    if profile['source'] == "ACCOUNT_USAGE":
+        print(f"The query was found by {kind} in the ACCOUNT_USAGE schema.")
+    else:
+        print(f"The query (by {kind}) is not in the ACCOUNT_USAGE schema yet. Trying the INFORMATION_SCHEMA instead...")
+        if profile['source'] == "INFORMATION_SCHEMA":
+            print(f"The query was found by {kind} in INFORMATION_SCHEMA.")
+        elif kind == "ID":
+            print("Query not found (by ID) in INFORMATION_SCHEMA. Try the History tab in the Web UI.")
+            return
+        else:
+            notFound = profile['notFound']
+            if notFound['mode'] == "explain":
+                print("Query not found (by SQL) in INFORMATION_SCHEMA. Estimating it from its EXPLAIN plan, without running it...")
+            elif notFound['mode'] == "cache":
+                print(f"Query not found (by SQL) in INFORMATION_SCHEMA. Running the query, for at most {min(notFound['timeout'], CACHE_CHECK_SECONDS)} seconds, "
+                    "in case its result is cached, or it is quick...")
+            elif notFound['mode'] == "limit":
+                print(f"Query not found (by SQL) in INFORMATION_SCHEMA. Running the query, with at most {notFound['rowLimit']:,} rows, "
+                    f"for at most {notFound['timeout']} seconds...")
+                if profile['source'] == "EXECUTED":
+                    print("All metrics are measured on the capped query, and may underestimate the full query.")
+            else:
+                print(f"Query not found (by SQL) in INFORMATION_SCHEMA. Running the query, for at most {notFound['timeout']} seconds...")
+            if notFound['cancelled']:
+                print("The query has been cancelled. Estimating it from its EXPLAIN plan instead...")
+            if profile['source'] == None:
+                print("The query ran, but it is not in INFORMATION_SCHEMA.")
+                return
+
+    if profile['source'] == "ESTIMATED":
+        showEstimate(profile)
+    else:
+        showQueryHistory(profile)
+
+    # show the explain plan, in tabular form
+    print("=========================================================")
+    print("EXPLAIN PLAN:")
+    print(formatPlan(profile['plan']))
+
+def toJsonValue(value):
+    # json.dumps fallback, for the Snowflake column types
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+def flattenNodes(nodes, key):
+    # plan and operator trees, as flat lists of nodes, with the IDs of their children
+    return [dict({ name: value for name, value in node.items() if name != "children" },
+            children=[child[key] for child in node["children"]])
+        for node in nodes]
+
+def toRecord(profile):
+    """
+    The profile as a JSON-ready record, with flat lists of plan nodes and operators
+    """
+    record = { name: profile[name] for name in ["kind", "value", "source", "metrics", "estimated", "notFound",
+        "ranks", "baseline", "contention", "cost", "watched", "hints"] }
+    record["queryId"] = profile["metrics"].get("QUERY_ID") if profile["metrics"] != None else None
+    plan = profile["plan"]
+    record["plan"] = (dict({ name: plan[name] for name in PLAN_STATS },
+            operations=flattenNodes(plan["operations"], "id"), roots=[node["id"] for node in plan["roots"]])
+        if plan != None else None)
+    operators = profile["operators"]
+    record["operators"] = flattenNodes(operators["operators"], "id") if operators != None else None
+    return record
+
+def getParquetSchema(pa):
+    return pa.schema(
+        [("KIND", pa.string()), ("VALUE", pa.string()), ("SOURCE", pa.string())]
+        + [(name, pa.float64()) for name in PARQUET_METRICS + ["COMPUTE_CREDITS"]]
+        + [(name, pa.string()) for name in ["QUERY_ID", "QUERY_TEXT", "EXECUTION_STATUS", "WAREHOUSE_NAME", "USER_NAME", "START_TIME"]]
+        + [(name, pa.int64()) for name in ["NUMBER_OF_CALLS", "FREQUENT_RANK", "LONGEST_RANK", "HEAVY_RANK",
+            "EXPENSIVE_RANK", "PEAK_CONCURRENCY"]]
+        + [(name, pa.list_(pa.string())) for name in ["HINTS", "ESTIMATED", "REGRESSIONS"]]
+        + [(name, pa.string()) for name in ["METRICS_JSON", "CONTENTION_JSON", "PLAN_JSON", "OPERATORS_JSON"]])
+
+class ProfileWriter:
+    """
+    Writes each profile as soon as it is done: as text, as one JSON array, as NDJSON (one record per line),
+    or appended in batches of rows to a Parquet file, with flat metrics and the nested parts as JSON
+    """
+    def __init__(self, format = "text", out = None, outputFile = None, batchRows = PARQUET_BATCH_ROWS):
+        self.format = format
+        self.out = out
+        self.outputFile = outputFile
+        self.batchRows = batchRows
+        self.records = []
+        self.writer = None
+        self.ownsOut = format in ("json", "ndjson") and out == None and outputFile != None
+        if self.ownsOut:
+            self.out = open(outputFile, "w", encoding="utf-8")
+        elif out == None:
+            self.out = sys.stdout
+
+    def write(self, profile):
+        if self.format == "text":
+            showProfile(profile)
+            return
+        record = toRecord(profile)
+        if self.format == "ndjson":
+            self.out.write(json.dumps(record, default=toJsonValue) + "\n")
+            self.out.flush()
+        else:
+            self.records.append(record)
+            if self.format == "parquet" and len(self.records) >= self.batchRows:
+                self.writeParquet()
+
+    def writeParquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        rows = []
+        for record in self.records:
+            metrics = record["metrics"] or {}
+            ranks = record["ranks"] or {}
+            row = { "KIND": record["kind"], "VALUE": record["value"], "SOURCE": record["source"] }
+            for name in PARQUET_METRICS:
+                value = metrics.get(name)
+                row[name] = float(value) if isinstance(value, (int, float, Decimal)) else None
+            for name in ["QUERY_ID", "QUERY_TEXT", "EXECUTION_STATUS", "WAREHOUSE_NAME", "USER_NAME"]:
+                row[name] = None if metrics.get(name) == None else str(metrics.get(name))
+            row["START_TIME"] = toJsonValue(metrics["START_TIME"]) if metrics.get("START_TIME") != None else None
+            for name in ["NUMBER_OF_CALLS", "FREQUENT_RANK", "LONGEST_RANK", "HEAVY_RANK", "EXPENSIVE_RANK"]:
+                row[name] = ranks.get(name)
+            row["COMPUTE_CREDITS"] = record["cost"]["credits"] if record["cost"] != None else None
+            row["HINTS"] = [hint["name"] for hint in record["hints"]]
+            row["ESTIMATED"] = record["estimated"]
+            row["REGRESSIONS"] = [metric for metric, stats in (record["baseline"] or {}).items() if stats["regression"]]
+            row["PEAK_CONCURRENCY"] = record["contention"]["peakConcurrency"] if record["contention"] != None else None
+            for name in ["metrics", "contention", "plan", "operators"]:
+                row[name.upper() + "_JSON"] = json.dumps(record[name], default=toJsonValue)
+            rows.append(row)
+
+        table = pa.Table.from_pylist(rows, schema=getParquetSchema(pa))
+        if self.writer == None:
+            self.writer = pq.ParquetWriter(self.outputFile, table.schema)
+        self.writer.write_table(table)
+        self.records = []
+
+    def close(self):
+        if self.format == "json":
+            self.out.write(json.dumps(self.records, default=toJsonValue, indent=2) + "\n")
+        elif self.format == "parquet" and (len(self.records) > 0 or self.writer == None):
+            self.writeParquet()
+        if self.writer != None:
+            self.writer.close()
+        if self.ownsOut:
+            self.out.close()
+
+def getWatchLabels(props):
+    # why a completed query is profiled in the watch mode, if at all
+    fired = evaluateRules(toColumns(props), False, WATCH_RULES)
+    return [rule["label"] for rule in WATCH_RULES if rule["name"] in fired and fired[rule["name"]]]
+
+def pollQueryHistory(cur, watermark, seen, limit = INFORMATION_SCHEMA_RESULT_LIMIT):
+    """
+    Fetch the queries completed since the END_TIME high-watermark, from INFORMATION_SCHEMA, in END_TIME order,
+    re-reading a short overlap, with the queries already seen skipped by ID. When the result limit is hit,
+    the END_TIME range after the watermark is halved, so that no query is missed. Returns the new queries, and the new watermark
+    """
+    start = watermark - timedelta(seconds=WATCH_OVERLAP_SECONDS)
+    end = datetime.now(timezone.utc)
+    while True:
+        cur.execute(
+            f"select {', '.join(HISTORY_COLUMNS)} "
+            "from table(information_schema.query_history("
+            f"end_time_range_start => {UTC_TIME_SQL}, end_time_range_end => {UTC_TIME_SQL}, result_limit => {limit})) "
+            "where EXECUTION_STATUS not in ('RUNNING', 'QUEUED', 'BLOCKED', 'RESUMING_WAREHOUSE') "
+            f"and {NOT_PROFILER_SQL} "
+            "order by END_TIME",
+            (toMirrorTime(start), toMirrorTime(end)))
+        rows = cur.fetchall()
+        if len(rows) < limit or end - watermark <= timedelta(seconds=1):
+            break
+        end = watermark + (end - watermark) / 2
+
+    names = [col[0] for col in cur.description]
+    queries = []
+    for row in rows:
+        props = dict(zip(names, row))
+        if props['QUERY_ID'] in seen:
+            continue
+        seen[props['QUERY_ID']] = True
+        if len(seen) > WATCH_SEEN_IDS:
+            seen.popitem(last=False)
+        queries.append(props)
+    return queries, end
+
+def profileWatched(props, labels, con):
+    # profile of a query over the watch thresholds, with its operators
+    operators = getOperatorStats(props['QUERY_ID'], con) if props['EXECUTION_STATUS'] == 'SUCCESS' else None
+    profile = buildProfile("ID", props['QUERY_ID'], props, False, None, None, operators, con.cursor())
+    profile["watched"] = labels
+    return profile
+
+def writeWatched(writer, queryId, labels, future):
+    """
+    Write the profile of a watched query, or why it could not be profiled: one query never stops the poller
+    """
+    try:
+        profile = future.result()
+    except Exception as e:
+        print(f"\nThe query {queryId} ({', '.join(labels)}) could not be profiled: {e}")
+        return
+    if writer.format == "text":
+        print(f"\n#########################################################")
+        print(f"Over the watch thresholds: {', '.join(labels)}.")
+    try:
+        writer.write(profile)
+    except Exception as e:
+        print(f"\nThe profile of the query {queryId} could not be written: {e}")
+
+def watchQueries(args, con, writer):
+    """
+    Poll INFORMATION_SCHEMA.QUERY_HISTORY for the queries completed since the last poll, and profile those
+    over the watch thresholds on a pool of threads, each written in order as soon as it is done, until interrupted
+    """
+    cur = con.cursor()
+    seen = collections.OrderedDict()
+    watermark = datetime.now(timezone.utc)
+    pending = collections.deque()
+
+    def writeDone(wait = False):
+        while len(pending) > 0 and (wait or pending[0][2].done()):
+            queryId, labels, future = pending.popleft()
+            writeWatched(writer, queryId, labels, future)
+            sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=max(args.threads, 1)) as pool:
+        try:
+            while True:
+                queries, watermark = pollQueryHistory(cur, watermark, seen)
+                watched = 0
+                for props in queries:
+                    labels = getWatchLabels(props)
+                    if len(labels) > 0:
+                        pending.append((props['QUERY_ID'], labels, pool.submit(profileWatched, props, labels, con)))
+                        watched += 1
+                print(f"{len(queries):,} queries completed until {watermark:%H:%M:%S} UTC, {watched:,} over the watch thresholds.")
+                sys.stdout.flush()
+
+                # profiles written while waiting for the next poll
+                deadline = time.monotonic() + args.watchInterval
+                while time.monotonic() < deadline:
+                    writeDone()
+                    time.sleep(min(0.5, max(deadline - time.monotonic(), 0)))
+        except KeyboardInterrupt:
+            print("Stopped watching. Profiling the last queries over the watch thresholds...")
+        writeDone(wait=True)
+
+USAGE = (f"Usage: python query-profiler.py [option]\n"
+    + "--id queryId              - by the query ID from Snowflake\n"
+    + "--sql 'queryText'         - the query is passed inline, between single quotes\n"
+    + "--file queryFile          - the query is stored in a text file (usually myquery.sql)\n"
+    + "--batch batchFile         - query IDs (one per line) and/or SQL queries (ending with ;) in a file, or - for stdin\n"
+    + "--around time             - look up the queries around this UTC time first ('YYYY-MM-DD HH:MM', when they ran)\n"
+    + "--not-found mode          - for a query not found by SQL: explain (estimate it, by default), cache (run it for 5 seconds at most), limit, or run\n"
+    + "--timeout seconds         - cancel a query run after this time (60 by default), --row-limit n for the limit mode\n"
+    + "--contention              - show the queries competing on the same warehouse, and the warehouse load\n"
+    + "--mirror [mirrorFile]     - rank queries from a local mirror of QUERY_HISTORY (query_history.db by default)\n"
+    + "--sync                    - incrementally sync the local mirror first (--retention days, 31 by default)\n"
+    + "--refresh-cache           - compute again the cached leaderboards (--cache-ttl minutes, 60 by default, or --no-cache)\n"
+    + "--threads n               - max number of statements running at the same time (4 by default)\n"
+    + "--workload [days]         - the queries to fix first, over the whole workload of the last days (30 by default)\n"
+    + "--watch [seconds]         - profile the queries over the watch thresholds as they complete, polling every 30 seconds\n"
+    + "--format fmt              - text (by default), json, ndjson (one record per query), or parquet (with --output)\n"
+    + "--output outputFile       - write the json, ndjson, or parquet records to a file, instead of stdout\n"
+    + "--record fixtureFile      - record all statements and their results into a fixture file\n"
+    + "--replay fixtureFile      - replay the statements from a fixture file, instead of connecting to Snowflake\n"
+    + "--latency ms              - with --replay, inject a latency per statement (0 by default)\n"
+    + "--repeat n                - run n times, and show the statements, rows fetched, and min/median wall time\n"
+    + "--trace [traceFile]       - time the profiler's own statements, and save them as a Chrome trace (query-profiler-trace.json by default)\n"
+    + "--serve [socket]          - run as a server, with pooled connections, on a local Unix socket\n"
+    + "--client [socket]         - send the other options to the server, instead of connecting to Snowflake\n")
+
+def getArgParser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--id', dest='queryId')
     parser.add_argument('--sql', dest='queryText')
     parser.add_argument('--file', dest='queryFile')
-    args = parser.parse_args()
+    parser.add_argument('--batch', dest='batchFile')
+    parser.add_argument('--around', dest='aroundTime',
+        type=lambda value: datetime.fromisoformat(value).replace(tzinfo=timezone.utc))
+    parser.add_argument('--not-found', dest='notFound', choices=NOT_FOUND_MODES, default="explain")
+    parser.add_argument('--timeout', dest='timeout', type=int, default=RUN_TIMEOUT_SECONDS)
+    parser.add_argument('--row-limit', dest='rowLimit', type=int, default=RUN_ROW_LIMIT)
+    parser.add_argument('--contention', dest='contention', action='store_true')
+    parser.add_argument('--mirror', dest='mirrorFile', nargs='?', const=MIRROR_FILE)
+    parser.add_argument('--sync', dest='sync', action='store_true')
+    parser.add_argument('--retention', dest='retentionDays', type=int, default=MIRROR_RETENTION_DAYS)
+    parser.add_argument('--cache-ttl', dest='cacheTtl', type=int, default=CACHE_TTL_MINUTES)
+    parser.add_argument('--refresh-cache', dest='refreshCache', action='store_true')
+    parser.add_argument('--no-cache', dest='noCache', action='store_true')
+    parser.add_argument('--threads', dest='threads', type=int, default=CONCURRENCY)
+    parser.add_argument('--workload', dest='workloadDays', type=int, nargs='?', const=WORKLOAD_DAYS)
+    parser.add_argument('--watch', dest='watchInterval', type=int, nargs='?', const=WATCH_INTERVAL_SECONDS)
+    parser.add_argument('--format', dest='format', choices=OUTPUT_FORMATS, default="text")
+    parser.add_argument('--output', dest='outputFile')
+    parser.add_argument('--record', dest='recordFile')
+    parser.add_argument('--replay', dest='replayFile')
+    parser.add_argument('--latency', dest='latency', type=float, default=0)
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1)
+    parser.add_argument('--trace', dest='traceFile', nargs='?', const=TRACE_FILE)
+    parser.add_argument('--serve', dest='serveSocket', nargs='?', const=SERVER_SOCKET)
+    parser.add_argument('--client', dest='clientSocket', nargs='?', const=SERVER_SOCKET)
+    return parser
 
-    queryText = None
-    queryId = None
+def getEntries(args, stdin):
+    """
+    Get the queries to profile, by ID or SQL, or None when there is nothing to do
+    """
+    entries = []
     if args.queryId != None:
-        queryId = args.queryId
+        entries.append(("ID", args.queryId))
         print(f"Getting query by ID...")
-        
+
     elif args.queryText != None:
-        queryText = args.queryText
+        entries.append(("SQL", args.queryText))
         print(f"Getting query by SQL...")
 
     elif args.queryFile != None:
         with open(args.queryFile) as f:
-            queryText = f.read()
+            entries.append(("SQL", f.read()))
         print(f"Getting query by SQL from {args.queryFile} file...")
 
-    else:
-        print(f"Usage: python query-profiler.py [option]\n"
-            + "--id queryId              - by the query ID from Snowflake\n"
-            + "--sql 'queryText'         - the query is passed inline, between single quotes\n"
-            + "--file queryFile          - the query is stored in a text file (usually myquery.sql)\n")
-        sys.exit(2)
+    elif args.batchFile != None:
+        if args.batchFile == "-":
+            entries = readBatch(stdin)
+        else:
+            with open(args.batchFile) as f:
+                entries = readBatch(f)
+        print(f"Getting {len(entries)} queries by ID or SQL from {args.batchFile}...")
+
+    elif args.workloadDays != None:
+        print(f"Getting the workload of the last {args.workloadDays} days...")
 
-    # read profiles_db.conf
+    elif args.watchInterval != None:
+        print(f"Watching the queries completed, every {args.watchInterval} seconds (Ctrl+C to stop)...")
+
+    elif not args.sync:
+        return None
+    return entries
+
+def readConfig():
+    """
+    Read the [default] profile, and the optional thresholds and costs, from profiles_db.conf
+    """
     parser = configparser.ConfigParser()
     parser.read("profiles_db.conf")
     section = "default"
-    account = parser.get(section, "account")
-    user = parser.get(section, "user")
-    role = parser.get(section, "role")
-    warehouse = parser.get(section, "warehouse")
-    database = parser.get(section, "database")
-    schema = parser.get(section, "schema")
+    config = { name: parser.get(section, name)
+        for name in ["account", "user", "role", "warehouse", "database", "schema"] }
+    if parser.has_section("thresholds"):
+        for name, value in parser.items("thresholds"):
+            THRESHOLDS[name.upper()] = float(value)
+    if parser.has_section("costs"):
+        for name, value in parser.items("costs"):
+            COSTS[name.upper()] = float(value)
+    return config
 
+def connectWith(config):
     # change this to connect in a different way: SSO / PWD / KEY-PAIR
     connect_mode = "PWD"
-    con = connect(connect_mode, account, user, role, warehouse, database, schema)
+    return connect(connect_mode, config["account"], config["user"], config["role"],
+        config["warehouse"], config["database"], config["schema"])
+
+def profileQueries(args, entries, con, config, writer):
+    """
+    Sync the mirror, show the workload, and profile all queries, on an open connection
+    """
+    account = config["account"]
+    role = config["role"]
     cur = con.cursor()
 
-    # look in account_usage
-    props = {}
-    isAccountUsage = True
-    row = None
+    # open and sync the local mirror of query_history
+    db = None
+    if args.mirrorFile != None or args.sync:
+        db = openMirror(args.mirrorFile if args.mirrorFile != None else MIRROR_FILE)
+    if args.sync:
+        print("Syncing the local mirror of QUERY_HISTORY...")
+        synced, pruned, attributed = syncMirror(db, cur, args.retentionDays)
+        print(f"{synced:,} queries synced, {pruned:,} queries older than {args.retentionDays} days pruned, "
+            f"credits attributed to {attributed:,} queries.")
+    if args.workloadDays != None:
+        showWorkload(args.workloadDays, cur)
+    if args.watchInterval != None:
+        watchQueries(args, con, writer)
+    if len(entries) == 0:
+        if db != None:
+            db.close()
+        return
 
-    if queryId != None:
-        # look in account_usage by query ID
-        cur.execute(
-            "select top 1 * "
-            "from snowflake.account_usage.query_history "
-            "where query_id = ?",
-            (queryId,))
-        row = cur.fetchone()
-        if row != None:
-            print("The query was found by ID in the ACCOUNT_USAGE schema.")
-        else:
-            # look in information_schema by query ID
-            print("The query (by ID) is not in the ACCOUNT_USAGE schema yet. Trying the INFORMATION_SCHEMA instead...")
-            isAccountUsage = False
-            cur.execute(
-                "select top 1 * "
-                "from table(information_schema.query_history()) "
-                "where query_id = ?",
-                (queryId,))
-            row = cur.fetchone()
-            if row != None:
-                print("The query was found by ID in INFORMATION_SCHEMA.")
+    # look in account_usage, then in information_schema, for all queries at once
+    if db != None and not showMirrorStatus(db):
+        db = None
+    found = findQueries(entries, cur, db, args.aroundTime)
+
+    # rank all successful queries found in account_usage, in one pass, by fingerprint or query key
+    keyOf = (lambda props: queryFingerprint(props['QUERY_TEXT'])) if db != None else queryKey
+    queryKeys = [keyOf(props) for props, isAccountUsage in found
+        if isAccountUsage and props['EXECUTION_STATUS'] == 'SUCCESS']
+    cacheFile = None if args.noCache else getCacheFile(account, role)
+    if cacheFile != None and args.refreshCache and os.path.exists(cacheFile):
+        os.remove(cacheFile)
+
+    with ThreadPoolExecutor(max_workers=max(args.threads, 1)) as pool:
+        # the ranking and all EXPLAIN plans run at the same time, on their own cursors
+        ranks = {}
+        ranksFuture = None
+        if len(queryKeys) > 0:
+            if db != None:
+                ranks = getMirrorRanks(queryKeys, db)
             else:
-                print("Query not found (by ID) in INFORMATION_SCHEMA. Try the History tab in the Web UI.")
+                ranksFuture = pool.submit(getQueryRanks, queryKeys, con.cursor(), cacheFile, args.cacheTtl)
+        plans = [pool.submit(explainQuery, props['QUERY_TEXT'], con,
+                None if args.noCache else getPlanCacheFile(account, role, props['QUERY_TEXT']), args.cacheTtl)
+            if props != None else None
+            for props, isAccountUsage in found]
+        operators = [pool.submit(getOperatorStats, props['QUERY_ID'], con)
+            if props != None and props['EXECUTION_STATUS'] == 'SUCCESS' else None
+            for props, isAccountUsage in found]
+        # co-running queries of the whole batch, fetched once per warehouse and time window
+        contentionFuture = pool.submit(ContentionIndex().load, found, con.cursor()) if args.contention else None
+        if ranksFuture != None:
+            ranks = ranksFuture.result()
+
+        # baselines of all queries, by fingerprint, in the mirror
+        fingerprints = [queryFingerprint(props['QUERY_TEXT'] if props != None else value)
+            for (kind, value), (props, isAccountUsage) in zip(entries, found)]
+        baselines = getBaselines(fingerprints, db) if db != None else {}
+        credits = (getMirrorCredits([props['QUERY_ID'] for props, isAccountUsage in found if props != None], db)
+            if db != None else {})
+        index = contentionFuture.result() if contentionFuture != None else None
+
+        # profile each query, in order, as soon as it is done
+        for (kind, value), (props, isAccountUsage), plan, ops, fingerprint in zip(entries, found, plans, operators, fingerprints):
+            if writer.format == "text" and len(entries) > 1:
+                print(f"\n#########################################################")
+            writer.write(buildProfile(kind, value, props, isAccountUsage,
+                ranks.get(keyOf(props)) if props != None else None,
+                plan.result() if plan != None else None,
+                ops.result() if ops != None else None, cur, baselines.get(fingerprint),
+                args.notFound, args.timeout, args.rowLimit,
+                index.getContention(props, isAccountUsage) if index != None and props != None else None,
+                credits.get(props['QUERY_ID']) if props != None else None, plan != None))
+            sys.stdout.flush()
+
+    if db != None:
+        db.close()
+
+class ThreadLocalOutput:
+    """
+    Replaces sys.stdout in the server, so that what each request thread prints goes to its own client
+    """
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def current(self):
+        return getattr(self.local, "out", None) or self.default
+
+    def write(self, text):
+        return self.current().write(text)
+
+    def flush(self):
+        self.current().flush()
+
+class ConnectionPool:
+    """
+    Up to size connections, opened on demand, then reused by all requests
+    """
+    def __init__(self, config, size):
+        self.config = config
+        self.size = size
+        self.opened = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if self.opened < self.size:
+                    self.opened += 1
+                    return connectWith(self.config)
+            return self.idle.get()
+
+    def release(self, con, broken = False):
+        if broken:
+            con.close()
+            with self.lock:
+                self.opened -= 1
+        else:
+            self.idle.put(con)
+
+class ProfilerRequestHandler(socketserver.StreamRequestHandler):
+    """
+    One request per client connection: a JSON line with the parsed options, and the batch,
+    answered with the same text output as the CLI
+    """
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        out = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+        sys.stdout.local.out = out
+        try:
+            args = argparse.Namespace(**request["args"])
+            if args.aroundTime != None:
+                args.aroundTime = datetime.fromisoformat(args.aroundTime)
+            if args.watchInterval != None:
+                print("The watch mode is not available through the server.")
+                return
+            if args.format == "parquet" and args.outputFile == None:
+                print("The parquet format requires an --output file.")
                 return
 
-    else:
-        # look in account_usage by query SQL
-        cur.execute(
-            "select top 1 * "
-            "from snowflake.account_usage.query_history "
-            "where query_text = ?"
-            "order by start_time desc",
-            (queryText,))
-        row = cur.fetchone()
-        if row != None:
-            print("The query was found by SQL in the ACCOUNT_USAGE schema.")
+            # with structured records sent back, all other messages go to the server stderr
+            writer = ProfileWriter(args.format, out if args.outputFile == None else None, args.outputFile)
+            if args.format != "text" and args.outputFile == None:
+                sys.stdout.local.out = sys.stderr
+            entries = getEntries(args, io.StringIO(request.get("stdin", "")))
+            if entries == None:
+                print(USAGE)
+                return
+            con = self.server.pool.acquire()
+            broken = False
+            try:
+                profileQueries(args, entries, con, self.server.config, writer)
+            except (snowflake.connector.errors.OperationalError, snowflake.connector.errors.InterfaceError) as e:
+                broken = True
+                print(f"Error: {e}", file=out)
+            except snowflake.connector.errors.DatabaseError as e:
+                print(f"Error: {e}", file=out)
+            finally:
+                # only a lost session is discarded, not a connection where one statement failed
+                self.server.pool.release(con, broken or con.is_closed())
+                writer.close()
+        except Exception as e:
+            print(f"Error: {e}", file=out)
+        finally:
+            sys.stdout.local.out = None
+            out.detach()
+
+def serve(socketPath, config, poolSize):
+    """
+    Serve profile requests on a local Unix socket, with pooled connections and warm caches
+    """
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    os.makedirs(os.path.dirname(os.path.abspath(socketPath)), exist_ok=True)
+    sys.stdout = ThreadLocalOutput(sys.stdout)
+
+    with socketserver.ThreadingUnixStreamServer(socketPath, ProfilerRequestHandler) as server:
+        # only the current user may use its connections
+        os.chmod(socketPath, 0o600)
+        server.config = config
+        server.pool = ConnectionPool(config, max(poolSize, 1))
+        print(f"Serving profile requests on {socketPath}...", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socketPath)
+
+def runClient(socketPath, args):
+    """
+    Send the options to the server, with the content of the local files, and show its output
+    """
+    stdin = ""
+    if args.queryFile != None:
+        with open(args.queryFile) as f:
+            args.queryText = f.read()
+        args.queryFile = None
+    if args.batchFile != None:
+        if args.batchFile == "-":
+            stdin = sys.stdin.read()
         else:
-            # look in information_schema by query SQL
-            print("The query (by SQL) is not in the ACCOUNT_USAGE schema yet. Trying the INFORMATION_SCHEMA instead...")
-            cur.execute(
-                "select top 1 * "
-                "from table(information_schema.query_history()) "
-                "where query_text = ?"
-                "order by start_time desc",
-                (queryText,))
-            row = cur.fetchone()
-            if row != None:
-                print("The query was found by SQL in INFORMATION_SCHEMA.")
-            else:
-                print("Query not found (by SQL) in INFORMATION_SCHEMA. Running the query...")
-
-                # execute SQL query, and get query ID
-                cur.execute(queryText)
-                cur.execute("select last_query_id()")
-                row = cur.fetchone()
-                queryId = row[0]
-
-                # look in information_schema by query ID
-                cur.execute(
-                    "select top 1 * "
-                    "from table(information_schema.query_history()) "
-                    "where query_id = ?",
-                    (queryId,))
-                row = cur.fetchone()
-
-    # collect all row metrics values for this query
-    for idx, col in enumerate(cur.description):
-        props[col[0]] = row[idx]
-
-    # EXPLAIN plan
-    cur.execute(f"explain using text {props['QUERY_TEXT']}")
-    row = cur.fetchone()
-    explain = row[0]
+            with open(args.batchFile) as f:
+                stdin = f.read()
+        args.batchFile = "-"
+    if args.mirrorFile != None:
+        args.mirrorFile = os.path.abspath(args.mirrorFile)
+    if args.outputFile != None:
+        args.outputFile = os.path.abspath(args.outputFile)
 
-    # fill-in some properties from the explain plan
-    lines = explain.splitlines()
-    props["PARTITIONS_TOTAL"] = int(lines[1].split("=")[1].strip())
-    props["PARTITIONS_SCANNED"] = int(lines[2].split("=")[1].strip())
-    props["BYTES_SCANNED"] = int(lines[3].split("=")[1].strip())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        sock.sendall((json.dumps({ "args": vars(args), "stdin": stdin }, default=toJsonValue) + "\n").encode("utf-8"))
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sys.stdout.write(data.decode("utf-8", errors="replace"))
+            sys.stdout.flush()
 
-    showQueryHistory(props, isAccountUsage, cur)
+def main():
+    """
+    Main entry point of the CLI
+    """
+    args = getArgParser().parse_args()
 
-    # show the explain plan, in tabular form
-    print("=========================================================")
-    print("EXPLAIN PLAN:")
-    print(explain)
+    # thin client of a running server
+    if args.clientSocket != None:
+        socketPath = args.clientSocket
+        args.clientSocket = None
+        runClient(socketPath, args)
+        return
+
+    # long-running server
+    if args.serveSocket != None:
+        serve(args.serveSocket, readConfig(), args.threads)
+        return
+
+    if args.format == "parquet" and args.outputFile == None:
+        print("The parquet format requires an --output file.")
+        sys.exit(2)
+
+    # with structured records on stdout, all other messages go to stderr
+    writer = ProfileWriter(args.format, outputFile=args.outputFile)
+    structured = args.format != "text" and args.outputFile == None
+    with contextlib.redirect_stdout(sys.stderr) if structured else contextlib.nullcontext():
+        entries = getEntries(args, sys.stdin)
+        if entries == None:
+            print(USAGE)
+            sys.exit(2)
+
+        # replay the statements of a fixture, with the account and role of its recording,
+        # or read profiles_db.conf, and connect (recording the statements, to replay them later)
+        if args.replayFile != None:
+            con = FixtureConnection(args.replayFile, latency=args.latency)
+            config = con.fixture["config"]
+        else:
+            config = readConfig()
+            con = connectWith(config)
+            if args.recordFile != None:
+                con = FixtureConnection(args.recordFile, con, config)
+        fixture = con if isinstance(con, FixtureConnection) else None
+        if args.traceFile != None:
+            con = TracingConnection(con)
 
-    con.close()
+        # only the output of the first run is shown
+        wallTimes = []
+        try:
+            for run in range(max(args.repeat, 1)):
+                start = time.perf_counter()
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull) if run > 0 else contextlib.nullcontext():
+                    profileQueries(args, entries, con, config, writer if run == 0 else ProfileWriter())
+                wallTimes.append(time.perf_counter() - start)
+        finally:
+            con.close()
+            writer.close()
+        if fixture != None:
+            showRunStats(fixture.stats, wallTimes)
+        if args.traceFile != None:
+            showTrace(con.events)
+            saveTrace(con.events, con.start, args.traceFile)
+            print(f"Chrome trace saved to {args.traceFile}.", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
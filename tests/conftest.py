@@ -0,0 +1,7 @@
+import pytest
+
+from fakes import loadProfiler
+
+@pytest.fixture(scope="session")
+def profiler():
+    return loadProfiler()
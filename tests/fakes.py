@@ -0,0 +1,124 @@
+import re
+import json
+import time
+import threading
+import importlib.util
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+def loadProfiler():
+    """
+    query-profiler.py, loaded as a module (its file name cannot be imported)
+    """
+    spec = importlib.util.spec_from_file_location("query_profiler", Path(__file__).parent.parent / "query-profiler.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakeConnection:
+    """
+    Connection answering each statement with the columns and rows of the first matching pattern,
+    after an injected latency (in seconds), and keeping all statements issued, on all its cursors
+    """
+    def __init__(self, responses = (), latency = 0):
+        self.responses = [(re.compile(pattern, re.IGNORECASE | re.DOTALL), respond) for pattern, respond in responses]
+        self.latency = latency
+        self.statements = []
+        self.lock = threading.Lock()
+
+    def respond(self, sql, params):
+        with self.lock:
+            self.statements.append((sql, params))
+        if self.latency > 0:
+            time.sleep(self.latency)
+        for pattern, respond in self.responses:
+            if pattern.search(sql):
+                return respond(sql, params or ()) if callable(respond) else respond
+        return ["status"], [("ok",)]
+
+    def issued(self, pattern):
+        # statements issued matching a pattern
+        return [sql for sql, params in self.statements if re.search(pattern, sql, re.IGNORECASE | re.DOTALL)]
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rows = []
+
+    def execute(self, sql, params = None, **options):
+        names, rows = self.connection.respond(sql, params)
+        self.description = [(name, None, None, None, None, None, True) for name in names]
+        self.rows = list(rows)
+        return self
+
+    def fetchone(self):
+        return self.rows.pop(0) if len(self.rows) > 0 else None
+
+    def fetchmany(self, size = 1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+def historyRow(queryId, queryText, start):
+    # a successful query on an X-Small warehouse, scanning most of its partitions
+    return { "QUERY_ID": queryId, "QUERY_TEXT": queryText, "QUERY_PARAMETERIZED_HASH": f"h{queryId}",
+        "EXECUTION_STATUS": "SUCCESS", "TOTAL_ELAPSED_TIME": 18570, "COMPILATION_TIME": 1069, "EXECUTION_TIME": 17362,
+        "START_TIME": start, "END_TIME": start + timedelta(milliseconds=18570),
+        "USER_NAME": "ANALYST", "ROLE_NAME": "ANALYST", "DATABASE_NAME": "SNOWFLAKE_SAMPLE_DATA", "SCHEMA_NAME": "TPCH_SF100",
+        "WAREHOUSE_NAME": "COMPUTE_WH", "WAREHOUSE_SIZE": "X-Small", "WAREHOUSE_TYPE": "STANDARD",
+        "QUERY_LOAD_PERCENT": 100, "CLUSTER_NUMBER": 1, "CREDITS_USED_CLOUD_SERVICES": 0.000165, "ROWS_PRODUCED": 4,
+        "ROWS_INSERTED": 0, "ROWS_UPDATED": 0, "ROWS_DELETED": 0, "ROWS_UNLOADED": 0, "BYTES_WRITTEN": 0, "BYTES_DELETED": 0,
+        "INBOUND_DATA_TRANSFER_BYTES": 0, "OUTBOUND_DATA_TRANSFER_BYTES": 0, "EXTERNAL_FUNCTION_TOTAL_INVOCATIONS": 0,
+        "EXTERNAL_FUNCTION_TOTAL_SENT_ROWS": 0, "EXTERNAL_FUNCTION_TOTAL_RECEIVED_ROWS": 0,
+        "EXTERNAL_FUNCTION_TOTAL_SENT_BYTES": 0, "EXTERNAL_FUNCTION_TOTAL_RECEIVED_BYTES": 0,
+        "QUEUED_PROVISIONING_TIME": 139, "QUEUED_REPAIR_TIME": 0, "QUEUED_OVERLOAD_TIME": 0, "TRANSACTION_BLOCKED_TIME": 0,
+        "BYTES_SPILLED_TO_LOCAL_STORAGE": 0, "BYTES_SPILLED_TO_REMOTE_STORAGE": 0, "BYTES_SCANNED": 16490786816,
+        "PERCENTAGE_SCANNED_FROM_CACHE": 0.0, "PARTITIONS_TOTAL": 1022, "PARTITIONS_SCANNED": 1012, "QUERY_TYPE": "SELECT" }
+
+PLAN = { "GlobalStats": { "partitionsTotal": 1022, "partitionsAssigned": 1012, "bytesAssigned": 16490786816 },
+    "Operations": [[
+        { "id": 0, "operation": "Result", "expressions": ["LINEITEM.L_RETURNFLAG"] },
+        { "id": 1, "parentOperators": [0], "operation": "TableScan",
+            "objects": ["SNOWFLAKE_SAMPLE_DATA.TPCH_SF100.LINEITEM"], "expressions": ["L_RETURNFLAG"],
+            "partitionsTotal": 1022, "partitionsAssigned": 1012, "bytesAssigned": 16490786816 }]] }
+
+def sampleResponses(queries, start = None, source = "ACCOUNT_USAGE"):
+    """
+    Responses of an account where the queries (by ID, with their SQL) ran one per minute from start
+    (an hour ago by default): their QUERY_HISTORY rows (in ACCOUNT_USAGE, or only in INFORMATION_SCHEMA
+    when not there yet), leaderboards, EXPLAIN plans and operator stats
+    """
+    start = start or datetime.now(timezone.utc) - timedelta(hours=1)
+    rows = [historyRow(queryId, queryText, start + timedelta(minutes=i))
+        for i, (queryId, queryText) in enumerate(queries.items())]
+
+    def history(sql, params):
+        names = re.match(r"select (.*?) from", sql, re.IGNORECASE | re.DOTALL).group(1).split(", ")
+        if f"{source}.QUERY_HISTORY" not in sql.upper():
+            return names, []
+        return names, [tuple(row.get(name) for name in names) for row in rows
+            if row["QUERY_ID"] in params or row["QUERY_TEXT"] in params]
+
+    def leaderboards(sql, params):
+        keys = [row["QUERY_PARAMETERIZED_HASH"] for row in rows]
+        return ["BOARD", "QUERY_KEY", "VALUE", "TOTAL_TIME_SECONDS"], (
+            [("EXECS", key, 3, 55.7) for key in keys] + [("LONGEST", key, 7, None) for key in keys])
+
+    return [
+        (r"^with history as", leaderboards),
+        (r"query_history.*qualify", history),
+        (r"^explain using json", (["plan"], [(json.dumps(PLAN),)])),
+        (r"get_query_operator_stats", (["STEP_ID"], [])) ]
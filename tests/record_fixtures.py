@@ -0,0 +1,63 @@
+"""
+Records the fixtures of the benchmarks, from the fake sample account, as --record would from a real one,
+and replays them:
+python tests/record_fixtures.py
+"""
+import os
+import sys
+import contextlib
+from pathlib import Path
+
+from fakes import FakeConnection, loadProfiler, sampleResponses
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+CONFIG = { "account": "test", "role": "ANALYST" }
+QUERY_ID = "01a0ed89-0600-ed44-0047-8283000220ca"
+QUERY_TEXT = ("select l_returnflag, l_linestatus, sum(l_quantity) from snowflake_sample_data.tpch_sf100.lineitem "
+    "where l_shipdate <= dateadd(day, -90, to_date('1998-12-01')) group by l_returnflag, l_linestatus")
+
+# fixture name: (options, responses of the account)
+PATHS = {
+    "id": (["--id", QUERY_ID], sampleResponses({ QUERY_ID: QUERY_TEXT })),
+    "sql": (["--sql", QUERY_TEXT], sampleResponses({ QUERY_ID: QUERY_TEXT })),
+    "information_schema": (["--id", QUERY_ID],
+        sampleResponses({ QUERY_ID: QUERY_TEXT }, source="INFORMATION_SCHEMA")),
+    # not in QUERY_HISTORY until run
+    "run": (["--sql", QUERY_TEXT, "--not-found", "run"],
+        [(r"where QUERY_TEXT in", (["QUERY_ID"], [])), (r"last_query_id", (["ID"], [(QUERY_ID,)]))]
+        + sampleResponses({ QUERY_ID: QUERY_TEXT }, source="INFORMATION_SCHEMA")) }
+
+# statements issued and rows fetched, for each path of a profile
+ROUND_TRIPS = [
+    # lookup, ranking (2 rows), EXPLAIN, operator stats
+    ("id", 4, 4),
+    ("sql", 4, 4),
+    # 4 lookup windows in ACCOUNT_USAGE, 1 in INFORMATION_SCHEMA, EXPLAIN, operator stats
+    ("information_schema", 7, 2),
+    # 4 + 4 lookup windows, the run, its ID, its lookup in INFORMATION_SCHEMA, EXPLAIN, operator stats
+    ("run", 13, 3) ]
+
+def record(profiler, name, options, responses):
+    args = profiler.getArgParser().parse_args(options + ["--no-cache"])
+    con = profiler.FixtureConnection(str(FIXTURES_DIR / f"{name}.json"), FakeConnection(responses), CONFIG)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        profiler.profileQueries(args, profiler.getEntries(args, None), con, CONFIG, profiler.ProfileWriter())
+    con.close()
+    print(f"{name}: {con.stats['statements']} statements, {con.stats['rows']} rows.", file=sys.stderr)
+
+def replay(profiler, name, latency = 0):
+    """
+    Profile again the queries of a fixture, offline, as --replay would, and return the statements issued
+    and rows fetched
+    """
+    options, responses = PATHS[name]
+    args = profiler.getArgParser().parse_args(options + ["--no-cache"])
+    con = profiler.FixtureConnection(str(FIXTURES_DIR / f"{name}.json"), latency=latency)
+    profiler.profileQueries(args, profiler.getEntries(args, None), con, con.fixture["config"], profiler.ProfileWriter())
+    return con.stats
+
+if __name__ == "__main__":
+    profiler = loadProfiler()
+    FIXTURES_DIR.mkdir(exist_ok=True)
+    for name, (options, responses) in PATHS.items():
+        record(profiler, name, options, responses)
@@ -0,0 +1,19 @@
+import io
+
+import pytest
+
+QUERY_ID = "01a3b2c4-0000-1111-0000-000000000001"
+
+@pytest.mark.parametrize("text, entries", [
+    # a ';' ending a line in a literal, comment or quoted identifier does not end the query
+    ("select 'a;\nb' from t;\n", [("SQL", "select 'a;\nb' from t;")]),
+    ("select 1 -- note;\nfrom t;\n", [("SQL", "select 1 -- note;\nfrom t;")]),
+    ("select $$a;\nb$$;\n", [("SQL", "select $$a;\nb$$;")]),
+    ("select /* x;\n*/ 1;\n", [("SQL", "select /* x;\n*/ 1;")]),
+    ('select "a;\nb" from t;\n', [("SQL", 'select "a;\nb" from t;')]),
+    # a top-level ';' does, even before a comment
+    ("select 1; -- done;\nselect 2;\n", [("SQL", "select 1; -- done;"), ("SQL", "select 2;")]),
+    (f"select 'x';\n{QUERY_ID}\n", [("SQL", "select 'x';"), ("ID", QUERY_ID)]),
+])
+def test_readBatch(profiler, text, entries):
+    assert profiler.readBatch(io.StringIO(text)) == entries
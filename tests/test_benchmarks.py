@@ -0,0 +1,14 @@
+import pytest
+
+from record_fixtures import ROUND_TRIPS, replay
+
+pytest.importorskip("pytest_benchmark")
+
+# injected per replayed statement, as a fast network round trip
+LATENCY_MS = 5
+
+@pytest.mark.parametrize("name, statements, rows", ROUND_TRIPS)
+def test_benchmarkProfile(profiler, benchmark, name, statements, rows):
+    stats = benchmark(replay, profiler, name, LATENCY_MS)
+    benchmark.extra_info.update(stats)
+    assert stats == { "statements": statements, "rows": rows }
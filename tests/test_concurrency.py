@@ -0,0 +1,59 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from fakes import FakeConnection, sampleResponses
+
+CONFIG = { "account": "test", "role": "ANALYST" }
+QUERIES = { f"01a0ed89-0600-ed44-0047-82830002{i:04d}": f"select l_returnflag, count(*) from lineitem where l_quantity > {i}"
+    for i in range(20) }
+START = datetime.now(timezone.utc) - timedelta(hours=1)
+LATENCY = 0.05
+
+def profileBatch(profiler, tmp_path, capsys, threads):
+    """
+    Profile the whole batch with a latency injected per statement, and return the wall time,
+    the output, and the connection
+    """
+    batchFile = tmp_path / "batch.txt"
+    batchFile.write_text("\n".join(QUERIES))
+    args = profiler.getArgParser().parse_args(["--batch", str(batchFile), "--no-cache", "--threads", str(threads)])
+    entries = profiler.getEntries(args, None)
+    con = FakeConnection(sampleResponses(QUERIES, START), latency=LATENCY)
+    capsys.readouterr()
+
+    start = time.perf_counter()
+    profiler.profileQueries(args, entries, con, CONFIG, profiler.ProfileWriter())
+    return time.perf_counter() - start, capsys.readouterr().out, con
+
+def test_concurrentStatements(profiler, tmp_path, capsys):
+    sequential, expected, con = profileBatch(profiler, tmp_path, capsys, 1)
+    concurrent, output, con = profileBatch(profiler, tmp_path, capsys, 4)
+
+    # one lookup and one ranking, then an EXPLAIN and operator stats per query
+    assert len(con.statements) == 2 + 2 * len(QUERIES)
+    assert len(con.issued(r"^explain using json")) == len(QUERIES)
+    # same output, in the same order, with the statements in flight at the same time
+    assert output == expected
+    assert all(queryId in output for queryId in QUERIES)
+    with capsys.disabled():
+        print(f"\n{len(con.statements)} statements at {LATENCY * 1000:.0f} ms: "
+            f"{sequential:.2f} s with 1 thread, {concurrent:.2f} s with 4 threads")
+    assert concurrent < sequential / 2
+
+def test_unexplainedStatement(profiler, tmp_path, capsys):
+    queries = { "01a0ed89-0600-ed44-0047-828300020001": "select 1",
+        "01a0ed89-0600-ed44-0047-828300020002": "call my_proc()",
+        "01a0ed89-0600-ed44-0047-828300020003": "select 3" }
+    def cannotExplain(sql, params):
+        raise profiler.snowflake.connector.errors.ProgrammingError("cannot explain CALL")
+    batchFile = tmp_path / "batch.txt"
+    batchFile.write_text("\n".join(queries))
+    args = profiler.getArgParser().parse_args(["--batch", str(batchFile), "--no-cache", "--threads", "4"])
+    con = FakeConnection([(r"^explain using \w+ call", cannotExplain)] + sampleResponses(queries, START))
+
+    # the batch goes on, and the CALL is not explained again
+    profiler.profileQueries(args, profiler.getEntries(args, None), con, CONFIG, profiler.ProfileWriter())
+    output = capsys.readouterr().out
+    assert all(queryId in output for queryId in queries)
+    assert output.count("The query cannot be explained") == 1
+    assert len(con.issued(r"^explain using \w+ call")) == 2
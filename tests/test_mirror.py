@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fakes import FakeConnection
+
+def addRuns(profiler, db, fingerprint, elapsedTimes, start = None):
+    # successful runs of one fingerprint, one per minute
+    start = start or datetime.now(timezone.utc) - timedelta(days=1)
+    for i, elapsed in enumerate(elapsedTimes):
+        db.execute("insert into query_history (QUERY_ID, QUERY_TEXT, START_TIME, TOTAL_ELAPSED_TIME, BYTES_SCANNED, "
+            "PARTITIONS_SCANNED, FINGERPRINT) values (?, ?, ?, ?, ?, ?, ?)",
+            (f"{fingerprint}-{start + timedelta(minutes=i)}", "select 1", profiler.toMirrorTime(start + timedelta(minutes=i)), elapsed, 100, 1, fingerprint))
+
+def test_getMirrorRanksManyFingerprints(profiler, tmp_path):
+    db = profiler.openMirror(str(tmp_path / "mirror.db"))
+    addRuns(profiler, db, "f1", [1000, 2000, 3000])
+    addRuns(profiler, db, "f2", [5000])
+
+    # more fingerprints than SQLite allows terms in a compound select (500)
+    fingerprints = ["f1", "f2"] + [f"missing{i}" for i in range(1000)]
+    ranks = profiler.getMirrorRanks(fingerprints, db)
+    assert len(ranks) == len(fingerprints)
+    assert ranks["f1"]["NUMBER_OF_CALLS"] == 3
+    assert ranks["f1"]["TOTAL_TIME_SECONDS"] == 6.0
+    assert ranks["f1"]["FREQUENT_RANK"] == 1
+    assert ranks["f2"]["LONGEST_RANK"] == 1
+    assert ranks["missing0"]["NUMBER_OF_CALLS"] == 0
+    db.close()
+
+def meteringResponses(hour, executions):
+    # executions (QUERY_ID, start and end minutes from the hour) on one warehouse,
+    # metered 4 credits in the hour, and 1 credit in the next
+    history = [(queryId, "select 1", hour + timedelta(minutes=start), (end - start) * 60000, 100, None, 1, 0, 0,
+        "WH", hour + timedelta(minutes=end), (end - start) * 60000) for queryId, start, end in executions]
+    metering = [("WH", hour, hour + timedelta(hours=1), 4), ("WH", hour + timedelta(hours=1), hour + timedelta(hours=2), 1)]
+    return [(r"ACCOUNT_USAGE\.QUERY_HISTORY", ([], history)), (r"WAREHOUSE_METERING_HISTORY", ([], metering))]
+
+def getCredits(db):
+    return { queryId: round(credits, 6) for queryId, credits in db.execute("select QUERY_ID, CREDITS from query_history") }
+
+def test_attributeCredits(profiler, tmp_path):
+    db = profiler.openMirror(str(tmp_path / "mirror.db"))
+    hour = (datetime.now(timezone.utc) - timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+    # 30, 10 and 10 minutes executing in the hour, the last one running 20 minutes into the next
+    con = FakeConnection(meteringResponses(hour, [("q1", 0, 30), ("q2", 30, 40), ("q3", 50, 80)]))
+    synced, pruned, attributed = profiler.syncMirror(db, con.cursor())
+    assert (synced, attributed) == (3, 3)
+
+    # 4 credits over 50 execution minutes, then 1 credit for q3 alone
+    expected = { "q1": 2.4, "q2": 0.8, "q3": 1.8 }
+    assert getCredits(db) == expected
+
+    # the same, synced again from the overlap, or from a start in the next hour
+    profiler.syncMirror(db, con.cursor())
+    assert getCredits(db) == expected
+    profiler.attributeCredits(db, profiler.toMirrorTime(hour + timedelta(minutes=70)))
+    assert getCredits(db) == expected
+    db.close()
+
+def test_updateBaselines(profiler, tmp_path):
+    db = profiler.openMirror(str(tmp_path / "mirror.db"))
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    addRuns(profiler, db, "f1", range(1000, 21000, 1000), start)
+    profiler.updateBaselines(db, profiler.toMirrorTime(start - timedelta(days=1)))
+
+    # quantiles within the accuracy of the sketch
+    baseline = profiler.getBaselines(["f1"], db)["f1"]
+    assert baseline["TOTAL_ELAPSED_TIME"]["runs"] == 20
+    assert baseline["TOTAL_ELAPSED_TIME"]["p50"] == pytest.approx(10000, rel=0.02)
+    assert baseline["TOTAL_ELAPSED_TIME"]["p95"] == pytest.approx(19000, rel=0.02)
+    assert baseline["BYTES_SCANNED"]["runs"] == 20
+
+    # the runs about to be pruned are removed, the runs baselined already are not added again
+    addRuns(profiler, db, "f1", [50000], start + timedelta(hours=1))
+    profiler.updateBaselines(db, profiler.toMirrorTime(start + timedelta(minutes=10)))
+    baseline = profiler.getBaselines(["f1"], db)["f1"]
+    assert baseline["TOTAL_ELAPSED_TIME"]["runs"] == 11
+    assert baseline["TOTAL_ELAPSED_TIME"]["p50"] == pytest.approx(16000, rel=0.02)
+    db.close()
+
+def test_compareBaseline(profiler, tmp_path):
+    db = profiler.openMirror(str(tmp_path / "mirror.db"))
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    addRuns(profiler, db, "steady", range(1000, 21000, 1000), start)
+    # recent runs 5 times slower than the median
+    addRuns(profiler, db, "shifted", [1000] * 20 + [5000] * 20, start)
+    addRuns(profiler, db, "new", [1000] * 3, start)
+    profiler.updateBaselines(db, profiler.toMirrorTime(start - timedelta(days=1)))
+    baselines = profiler.getBaselines(["steady", "shifted", "new"], db)
+
+    comparison = profiler.compareBaseline(baselines["steady"], { "TOTAL_ELAPSED_TIME": 25000, "BYTES_SCANNED": 100 })
+    assert comparison["TOTAL_ELAPSED_TIME"]["regression"]
+    assert not comparison["TOTAL_ELAPSED_TIME"]["shift"]
+    assert not comparison["BYTES_SCANNED"]["regression"]
+    assert not profiler.compareBaseline(baselines["steady"], { "TOTAL_ELAPSED_TIME": 10000 })["TOTAL_ELAPSED_TIME"]["regression"]
+
+    assert profiler.compareBaseline(baselines["shifted"], { "TOTAL_ELAPSED_TIME": 5000 })["TOTAL_ELAPSED_TIME"]["shift"]
+
+    # not enough runs to tell
+    comparison = profiler.compareBaseline(baselines["new"], { "TOTAL_ELAPSED_TIME": 100000 })
+    assert not comparison["TOTAL_ELAPSED_TIME"]["regression"]
+    assert comparison["TOTAL_ELAPSED_TIME"]["value"] == 100000
+    db.close()
@@ -0,0 +1,23 @@
+from fakes import FakeConnection
+
+def failingExplain(profiler):
+    def respond(sql, params):
+        raise profiler.snowflake.connector.errors.ProgrammingError("Object 'TYPO' does not exist")
+    return respond
+
+def test_estimateUnexplained(profiler):
+    con = FakeConnection([(r"^explain", failingExplain(profiler))])
+    profile = profiler.buildProfile("SQL", "select * from typo", None, False, None, None, None, con.cursor())
+
+    # estimated, with nothing to estimate from
+    assert profile["source"] == "ESTIMATED"
+    assert profile["plan"] == None
+    assert profile["estimated"] == []
+    assert profile["metrics"] == { "QUERY_TEXT": "select * from typo" }
+
+def test_runLimitedWithComment(profiler):
+    con = FakeConnection([(r"last_query_id", (["ID"], [("01a3",)])), (r"query_history", (["QUERY_ID"], []))])
+    profiler.runQuery("select 1 -- trailing comment", con.cursor(), "limit", rowLimit=10)
+
+    # the row cap is not commented out
+    assert con.statements[0][0] == "select * from (select 1 -- trailing comment\n) limit 10"
@@ -0,0 +1,68 @@
+import json
+
+from fakes import FakeConnection
+
+KEYS = ["h1", "h2"]
+
+def leaderboards(sql, params):
+    # the execs of all queries, and the month-wide leaderboards
+    return ["BOARD", "QUERY_KEY", "VALUE", "TOTAL_TIME_SECONDS"], [
+        ("EXECS", "h1", 12, 55.7), ("EXECS", "h2", 1, 0.5), ("EXECS", "other", 40, 12.0),
+        ("FREQUENT", "h1", 3, None), ("FREQUENT", "other", 1, None),
+        ("LONGEST", "h2", 42, None), ("HEAVY", "h1", 7, None)]
+
+RESPONSES = [(r"^with history as", leaderboards)]
+
+def test_getQueryRanksOneStatement(profiler):
+    con = FakeConnection(RESPONSES)
+    ranks = profiler.getQueryRanks(KEYS, con.cursor())
+
+    # all ranks in a single pass over ACCOUNT_USAGE
+    assert len(con.statements) == 1
+    assert len(con.issued(r"^with history as")) == 1
+    assert ranks["h1"] == { "NUMBER_OF_CALLS": 12, "TOTAL_TIME_SECONDS": 55.7,
+        "FREQUENT_RANK": 3, "LONGEST_RANK": None, "HEAVY_RANK": 7 }
+    assert ranks["h2"] == { "NUMBER_OF_CALLS": 1, "TOTAL_TIME_SECONDS": 0.5,
+        "FREQUENT_RANK": None, "LONGEST_RANK": 42, "HEAVY_RANK": None }
+
+def test_getQueryRanksDuplicateKeys(profiler):
+    con = FakeConnection(RESPONSES)
+    ranks = profiler.getQueryRanks(KEYS + KEYS, con.cursor())
+
+    assert len(con.statements) == 1
+    assert sorted(ranks) == KEYS
+
+def test_getQueryRanksCached(profiler, tmp_path):
+    cacheFile = str(tmp_path / "leaderboards.json")
+    first = FakeConnection(RESPONSES)
+    profiler.getQueryRanks(KEYS, first.cursor(), cacheFile)
+
+    # with fresh leaderboards, the execs of any query are cached too: no scan at all
+    second = FakeConnection(RESPONSES)
+    ranks = profiler.getQueryRanks(["h1", "other", "new"], second.cursor(), cacheFile)
+    assert second.statements == []
+    assert ranks["h1"] == { "NUMBER_OF_CALLS": 12, "TOTAL_TIME_SECONDS": 55.7,
+        "FREQUENT_RANK": 3, "LONGEST_RANK": None, "HEAVY_RANK": 7 }
+    assert ranks["other"]["NUMBER_OF_CALLS"] == 40
+    assert ranks["new"]["NUMBER_OF_CALLS"] == 0
+
+def test_getQueryRanksExpiredCache(profiler, tmp_path):
+    cacheFile = str(tmp_path / "leaderboards.json")
+    profiler.getQueryRanks(KEYS, FakeConnection(RESPONSES).cursor(), cacheFile)
+
+    con = FakeConnection(RESPONSES)
+    profiler.getQueryRanks(KEYS, con.cursor(), cacheFile, ttlMinutes=-1)
+    assert len(con.statements) == 1
+    assert len(con.issued(r"^with history as")) == 1
+
+def test_getQueryRanksOldCache(profiler, tmp_path):
+    # leaderboards cached with no execs are computed again
+    cacheFile = str(tmp_path / "leaderboards.json")
+    profiler.saveCache(cacheFile, { "FREQUENT": {}, "LONGEST": {}, "HEAVY": {} })
+
+    con = FakeConnection(RESPONSES)
+    ranks = profiler.getQueryRanks(KEYS, con.cursor(), cacheFile)
+    assert len(con.statements) == 1
+    assert ranks["h1"]["NUMBER_OF_CALLS"] == 12
+    with open(cacheFile) as f:
+        assert "execs" in json.load(f)["data"]
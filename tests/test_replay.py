@@ -0,0 +1,14 @@
+import pytest
+
+from record_fixtures import QUERY_ID, ROUND_TRIPS, replay
+
+@pytest.mark.parametrize("name, statements, rows", ROUND_TRIPS)
+def test_replayRoundTrips(profiler, name, statements, rows):
+    assert replay(profiler, name) == { "statements": statements, "rows": rows }
+
+def test_replayRun(profiler, capsys):
+    replay(profiler, "run")
+    output = capsys.readouterr().out
+    assert "Query not found (by SQL) in INFORMATION_SCHEMA. Running the query" in output
+    assert f"The query ID is {QUERY_ID}." in output
+    assert "Statement not recorded" not in output
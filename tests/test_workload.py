@@ -0,0 +1,37 @@
+import pytest
+
+from fakes import FakeConnection, FakeCursor
+
+COLUMNS = ["QUERY_KEY", "TOTAL_ELAPSED_TIME", "BYTES_SCANNED", "BYTES_SPILLED_TO_LOCAL_STORAGE",
+    "BYTES_SPILLED_TO_REMOTE_STORAGE", "PERCENTAGE_SCANNED_FROM_CACHE", "PARTITIONS_SCANNED", "PARTITIONS_TOTAL"]
+ROWS = [("h1", 1000, 10, 0, 0, 0.5, 1, 2), ("h1", 3000, 30, 0, 0, 0.5, 1, 2), ("h2", 500, 0, 0, 0, 0, 0, 0)]
+
+class NoPandasCursor(FakeCursor):
+    """
+    Cursor of a connector failing to fetch DataFrames, with the error of the connector
+    """
+    def __init__(self, connection, error):
+        super().__init__(connection)
+        self.error = error
+
+    def fetch_pandas_batches(self):
+        raise self.error
+
+def test_getWorkloadWithoutPandas(profiler):
+    error = profiler.snowflake.connector.errors.ProgrammingError(
+        msg="Optional dependency: 'pandas' is not installed", errno=profiler.NO_PANDAS_ERRNO)
+    cur = NoPandasCursor(FakeConnection([(r"QUERY_HISTORY", (COLUMNS, ROWS))]), error)
+
+    # the rows are fetched in batches instead
+    aggregates = profiler.getWorkload(30, cur)
+    assert sorted(aggregates) == ["h1", "h2"]
+    assert aggregates["h1"]["count"] == 2
+    assert aggregates["h1"]["elapsed"] == 4000
+    assert aggregates["h1"]["bytesScanned"] == 40
+
+def test_getWorkloadError(profiler):
+    error = profiler.snowflake.connector.errors.ProgrammingError(msg="Result not found", errno=1)
+    cur = NoPandasCursor(FakeConnection([(r"QUERY_HISTORY", (COLUMNS, ROWS))]), error)
+
+    with pytest.raises(profiler.snowflake.connector.errors.ProgrammingError):
+        profiler.getWorkload(30, cur)